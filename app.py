@@ -1,22 +1,35 @@
 import streamlit as st
-import time
 import os
-import json
+import copy
+import uuid
 import datetime
-import cv2
-import re
-import numpy as np
-import google.generativeai as genai
 from io import BytesIO
 import base64
-from PIL import Image as PILImage
-from openpyxl import Workbook
-from openpyxl.styles import Alignment, Font, Border, Side
-from openpyxl.drawing.image import Image as ExcelImage
-from gtts import gTTS
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
 from streamlit_drawable_canvas import st_canvas
 import streamlit_drawable_canvas as canvas_lib
+from manual_core import (
+    CANVAS_HEIGHT,
+    CANVAS_WIDTH,
+    PerfRecorder,
+    STRIP_INTERVAL,
+    clean_timestamp,
+    clear_remote_files,
+    EXCEL_IMAGE_FORMATS,
+    EXCEL_IMAGE_MAX_SIZE,
+    EXCEL_IMAGE_QUALITY,
+    compute_export_key,
+    export_excel_to_disk,
+    extract_frame_as_pil,
+    frame_strip_paths,
+    get_frame_strip,
+    get_gemini_client,
+    get_job_manager,
+    get_keyframe_index,
+    get_narration_cache,
+    get_video_store,
+    keyframe_index_path,
+    set_perf_recorder,
+)
 
 # --- 0. 決定的修正パッチ ---
 def fix_canvas_library():
@@ -69,15 +82,18 @@ st.markdown("""
     </style>
     """, unsafe_allow_html=True)
 
+# 処理時間の計測結果はセッションごとに記録する（解析ジョブのスレッドにも引き継がれる）
+if "perf_recorder" not in st.session_state: st.session_state.perf_recorder = PerfRecorder()
+set_perf_recorder(st.session_state.perf_recorder)
+
 # --- 2. モデルリスト取得関数 ---
 @st.cache_data(ttl=600)
 def get_available_models(api_key):
     default_models = ["gemini-1.5-flash", "gemini-2.0-flash-exp"]
     if not api_key: return default_models
     try:
-        genai.configure(api_key=api_key)
         models = []
-        for m in genai.list_models():
+        for m in get_gemini_client(api_key).list_models():
             if 'generateContent' in m.supported_generation_methods:
                 name = m.name.replace("models/", "")
                 if "deep-research" in name or "ultra" in name:
@@ -94,206 +110,100 @@ def get_available_models(api_key):
         return default_models
 
 # --- 3. データ処理用ヘルパー関数群 ---
-def clean_timestamp(ts_value):
-    if ts_value is None: return 0.0
-    if isinstance(ts_value, (int, float)): return float(ts_value)
-    s = str(ts_value).strip()
-    try:
-        return float(s)
-    except ValueError:
-        if ":" in s:
-            parts = s.split(":")
-            if len(parts) == 2:
-                try: return float(parts[0]) * 60 + float(parts[1])
-                except: pass
-        numbers = re.findall(r"\d+\.?\d*", s)
-        if numbers: return float(numbers[0])
-    return 0.0
-
-def extract_frame_as_pil(video_path, seconds):
-    cap = cv2.VideoCapture(video_path)
-    cap.set(cv2.CAP_PROP_POS_MSEC, seconds * 1000)
-    ret, frame = cap.read()
-    cap.release()
-    if ret:
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        return PILImage.fromarray(frame)
-    return None
-
-@st.cache_data
-def generate_audio_bytes(text):
-    try:
-        if not text: return None
-        tts = gTTS(text=text, lang='ja')
-        fp = BytesIO()
-        tts.write_to_fp(fp)
-        fp.seek(0)
-        return fp.read()
-    except Exception:
-        return None
-
-# --- 4. Excel作成関数 ---
-def create_excel_file(steps, m_num, m_author, m_date, video_path):
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "作業手順書"
-
-    header_font = Font(bold=True, size=16)
-    meta_font = Font(size=11)
-    title_font = Font(bold=True, size=12)
-    normal_font = Font(size=11)
-    thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), 
-                         top=Side(style='thin'), bottom=Side(style='thin'))
-
-    ws['A1'] = f"No: {m_num}"
-    ws['A1'].font = Font(bold=True, size=11)
-    ws['C1'] = f"作成日: {m_date.strftime('%Y/%m/%d')}"
-    ws['C1'].font = meta_font
-    ws['C1'].alignment = Alignment(horizontal='right')
-    ws['C2'] = f"作成者: {m_author}"
-    ws['C2'].font = meta_font
-    ws['C2'].alignment = Alignment(horizontal='right')
-    ws.merge_cells('A3:C3')
-    ws['A3'] = "標準作業手順書"
-    ws['A3'].font = header_font
-    ws['A3'].alignment = Alignment(horizontal='center', vertical='center')
-
-    start_row = 5
-    ws[f'A{start_row}'] = "No."
-    ws[f'B{start_row}'] = "作業画像"
-    ws[f'C{start_row}'] = "作業内容・手順"
-    ws.column_dimensions['A'].width = 6
-    ws.column_dimensions['B'].width = 45
-    ws.column_dimensions['C'].width = 55
-    for col in ['A', 'B', 'C']:
-        cell = ws[f'{col}{start_row}']
-        cell.font = title_font
-        cell.alignment = Alignment(horizontal='center', vertical='center')
-        cell.border = thin_border
-
-    current_row = start_row + 1
-    for i, step in enumerate(steps, 1):
-        ws.row_dimensions[current_row].height = 180
-        cell_no = ws[f'A{current_row}']
-        cell_no.value = i
-        cell_no.alignment = Alignment(horizontal='center', vertical='center')
-        cell_no.border = thin_border
-        
-        cell_img = ws[f'B{current_row}']
-        cell_img.border = thin_border
-        
-        # --- 画像合成ロジック ---
-        final_img = None
-        
-        if video_path:
-            ts = clean_timestamp(step.get('timestamp', 0))
-            if ts >= 0:
-                final_img = extract_frame_as_pil(video_path, ts)
-
-        # ★修正：画像データ(edited_image_data)を使って合成
-        if final_img and 'edited_image_data' in step and step['edited_image_data'] is not None:
-            try:
-                drawing_layer = PILImage.fromarray(step['edited_image_data'].astype('uint8'), 'RGBA')
-                drawing_layer = drawing_layer.resize(final_img.size, PILImage.Resampling.LANCZOS)
-                final_img.paste(drawing_layer, (0, 0), drawing_layer)
-            except Exception as e:
-                print(f"Image merge error: {e}")
-
-        if final_img:
-            try:
-                final_img.thumbnail((320, 240))
-                img_byte_arr = BytesIO()
-                final_img.save(img_byte_arr, format='PNG')
-                img_byte_arr.seek(0)
-                excel_img = ExcelImage(img_byte_arr)
-                excel_img.anchor = f'B{current_row}'
-                ws.add_image(excel_img)
-            except Exception:
-                cell_img.value = "[画像処理エラー]"
-        else:
-            cell_img.value = "[画像なし]"
-
-        cell_text = ws[f'C{current_row}']
-        cell_text.value = f"【{step['title']}】\n\n{step['text']}"
-        cell_text.alignment = Alignment(horizontal='left', vertical='top', wrap_text=True)
-        cell_text.border = thin_border
-        cell_text.font = normal_font
-        current_row += 1
-
-    output = BytesIO()
-    wb.save(output)
-    return output.getvalue()
-
-# --- 5. Gemini API処理 ---
-def process_video_with_gemini(video_path, api_key, selected_model):
-    genai.configure(api_key=api_key)
-    progress_bar = st.progress(0, text="準備中...")
-    try:
-        progress_bar.progress(10, text="📤 動画をAIサーバーにアップロード中...")
-        video_file = genai.upload_file(path=video_path)
-        
-        while video_file.state.name == "PROCESSING":
-            progress_bar.progress(30, text="⏳ AI側で動画を処理しています...（数秒〜数分）")
-            time.sleep(2)
-            video_file = genai.get_file(video_file.name)
-            
-        if video_file.state.name == "FAILED":
-            raise ValueError("動画の処理に失敗しました。")
-
-        progress_bar.progress(60, text=f"🤖 マニュアルを生成中...（モデル: {selected_model}）")
-        model = genai.GenerativeModel(model_name=selected_model)
-        
-        prompt = """
-        あなたは製造現場の熟練管理者です。添付の動画を見て、新人作業員のための「標準作業手順書」を作成してください。
-        以下のJSON形式で出力してください:
-        [
-            {"title": "手順の見出し", "text": "具体的な作業内容。", "timestamp": 5.5},...
-        ]
-        注意点: 
-        - timestampは必ず「秒数（数値）」だけにしてください。（例: 5.5）
-        """
-        safe = [
-            {"category": HarmCategory.HARM_CATEGORY_HARASSMENT, "threshold": HarmBlockThreshold.BLOCK_NONE},
-            {"category": HarmCategory.HARM_CATEGORY_HATE_SPEECH, "threshold": HarmBlockThreshold.BLOCK_NONE},
-            {"category": HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT, "threshold": HarmBlockThreshold.BLOCK_NONE},
-            {"category": HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT, "threshold": HarmBlockThreshold.BLOCK_NONE},
-        ]
-        response = model.generate_content(
-            [video_file, prompt],
-            generation_config={"response_mime_type": "application/json"},
-            safety_settings=safe
-        )
-        progress_bar.progress(100, text="完了！")
-        time.sleep(1)
-        progress_bar.empty()
-        return json.loads(response.text)
-    except Exception as e:
-        if "429" in str(e):
-            st.error(f"⚠️ API制限エラー: '{selected_model}' は利用不可または制限超過です。'gemini-1.5-flash' を選んでください。")
-        else:
-            st.error(f"エラーが発生しました: {e}")
-        return []
+def generate_all_narrations(steps):
+    # 全手順の音声をまとめて並列に作る。本文が変わっていない手順はディスクのキャッシュから返る
+    progress = st.progress(0, text="🔊 ナレーション音声を作成中...")
+    def on_progress(done, total):
+        progress.progress(done / total, text=f"🔊 ナレーション音声を作成中... ({done}/{total})")
+    _, errors = get_narration_cache().synthesize_all([step.get('text') for step in steps], on_progress=on_progress)
+    progress.empty()
+    if errors: st.warning("一部の音声を作成できませんでした: " + " / ".join(errors))
+
+def set_step_timestamp(i, seconds):
+    # ボタンのコールバックから呼ぶ。入力欄の状態を消して、手順側の秒数で作り直させる
+    step = st.session_state.manual_steps[i]
+    seconds = round(seconds, 1)
+    if clean_timestamp(step.get('timestamp', 0)) != seconds and st.session_state.get("excel_export") is not None:
+        # コールバックはフラグメントより先に動くので、フラグメント側の変更検知では気付けない。
+        # ここで作成済みのExcelを破棄し、フラグメントの再実行時にアプリ全体を再実行させる
+        st.session_state.excel_export = None
+        st.session_state.excel_export_dropped = True
+    step['timestamp'] = seconds
+    st.session_state.pop(f"ts_{i}", None)
+
+# --- 4. Excel出力（必要な時だけ作成 & 内容ハッシュごとにディスクへ保存） ---
+EXCEL_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+@st.fragment
+def render_excel_download(steps, m_num, m_author, m_date, video_path, image_options, label, key, **button_kwargs):
+    export_key = compute_export_key(steps, m_num, m_author, m_date, video_path, **image_options)
+    prepared = st.session_state.get("excel_export")
+    if not (prepared and prepared["key"] == export_key and os.path.exists(prepared["path"])):
+        if not st.button("📦 Excelファイルを作成", key=f"{key}_prepare", use_container_width=True):
+            return
+        with st.spinner("Excelを作成中..."):
+            path = export_excel_to_disk(export_key, steps, m_num, m_author, m_date, video_path, **image_options)
+        # セッションにはファイルの場所だけを持ち、中身はダウンロードボタンがファイルから読む
+        prepared = {"key": export_key, "path": path}
+        st.session_state.excel_export = prepared
+    with open(prepared["path"], "rb") as f:
+        st.download_button(label, f, f"{m_num}.xlsx", EXCEL_MIME, key=f"{key}_download", use_container_width=True, **button_kwargs)
+
+# --- 5. AI解析ジョブの進捗表示 ---
+JOB_REFRESH_INTERVAL = 1.5  # 画面側の進捗更新間隔（秒）
+PARTIAL_PREVIEW_SIZE = (640, 640)
+
+@st.fragment(run_every=JOB_REFRESH_INTERVAL)
+def render_analysis_job(job_id, video_path):
+    # 解析中はこの部分だけを定期的に再実行し、終わったらアプリ全体を更新する
+    job = get_job_manager().get(job_id)
+    if job is not None and job.active:
+        st.progress(job.progress, text=job.message)
+        partial_steps = sorted(job.partial_steps, key=lambda step: clean_timestamp(step.get('timestamp', 0)))
+        if partial_steps:
+            st.subheader("📝 編集 & プレビュー（生成中...）")
+            st.caption("生成が終わると編集できるようになります。")
+            # 更新のたびに全手順を描き直すので、サムネイル列があればそこから、無ければ640px版をキャッシュから出す
+            frame_strip = get_frame_strip(video_path) if os.path.exists(frame_strip_paths(video_path)[1]) else None
+            for i, step in enumerate(partial_steps):
+                c1, c2 = st.columns([1.5, 1])
+                with c1:
+                    ts = clean_timestamp(step.get('timestamp', 0))
+                    img = frame_strip.frame_at(ts, tolerance=STRIP_INTERVAL / 2) if frame_strip is not None else None
+                    if img is None: img = extract_frame_as_pil(video_path, ts, max_size=PARTIAL_PREVIEW_SIZE)
+                    if img is not None: st.image(img, use_container_width=True)
+                with c2:
+                    st.markdown(f"#### 手順 {i+1}: {step.get('title', '')}")
+                    st.write(step.get('text', ''))
+        return
+    st.session_state.analysis_job_id = None
+    if job is not None and job.status == "done" and job.result:
+        st.session_state.manual_steps = copy.deepcopy(job.result)
+        st.session_state.analysis_notice = job.notice
+    elif job is not None:
+        st.session_state.analysis_error = job.error or "解析結果が空でした。"
+    st.rerun()
 
 # --- 6. サーバー掃除機能 ---
-def clear_api_storage(api_key):
+def clear_api_storage(api_key, older_than_hours=None, only_unreferenced=False):
     if not api_key:
         st.sidebar.error("APIキーを入力してください")
         return
     try:
-        genai.configure(api_key=api_key)
-        files = list(genai.list_files())
-        if not files:
-            st.sidebar.success("削除するファイルはありませんでした。")
-            return
-        count = 0
         progress = st.sidebar.progress(0, text="削除中...")
-        for i, f in enumerate(files):
-            try: genai.delete_file(f.name)
-            except: pass
-            count += 1
-            progress.progress((i + 1) / len(files))
+        def on_progress(done, total):
+            progress.progress(done / total, text=f"削除中... ({done}/{total})")
+        report = clear_remote_files(api_key, older_than_hours, only_unreferenced, on_progress=on_progress)
         progress.empty()
-        st.sidebar.success(f"🧹 {count}個のファイルを削除しました！")
+        if not report.targets:
+            st.sidebar.success("削除するファイルはありませんでした。")
+            return
+        st.sidebar.success(f"🧹 {len(report.deleted)}個のファイルを削除しました！（対象外 {report.skipped}個）")
+        if report.failed:
+            st.sidebar.warning(f"⚠️ {len(report.failed)}個のファイルを削除できませんでした。")
+            with st.sidebar.expander("削除できなかったファイル"):
+                for name, error in report.failed:
+                    st.caption(f"{name}: {error}")
     except Exception as e:
         st.sidebar.error(f"削除エラー: {e}")
 
@@ -337,13 +247,18 @@ with st.sidebar:
                     break
         
         final_model_name = st.selectbox("使用モデル", available_models, index=default_index)
+        use_fallback = st.checkbox("🔀 生成できないときは他のモデルで自動的にやり直す", value=True, help="混雑や出力の崩れで失敗したとき、一覧の上位のモデルから順に試します")
+        fallback_models = [m for m in available_models if m != final_model_name] if use_fallback else []
         
         st.divider()
         with st.expander("🛠️ メンテナンス"):
+            older_than_hours = st.number_input("何時間より古いファイルを削除（0ですべて）", 0, 48, 0)
+            only_unreferenced = st.checkbox("再利用中の動画は残す", help="このサーバーのアップロード記録にあるファイルは削除しません")
             if st.button("🗑️ サーバーのゴミ箱を空にする", type="secondary"):
-                clear_api_storage(api_key)
+                clear_api_storage(api_key, older_than_hours or None, only_unreferenced)
     else:
         final_model_name = "gemini-1.5-flash"
+        fallback_models = []
 
     st.divider()
     st.header("📄 文書情報")
@@ -351,6 +266,106 @@ with st.sidebar:
     author_name = st.text_input("作成者", value="管理者")
     create_date = st.date_input("作成日", datetime.date.today())
 
+    with st.expander("🖼️ Excel画像設定"):
+        image_format = st.selectbox("画像形式", EXCEL_IMAGE_FORMATS, help="JPEGはファイルが小さく、現場PCでも軽く開けます")
+        image_quality = st.slider("JPEG画質", 40, 95, EXCEL_IMAGE_QUALITY, disabled=image_format != "JPEG")
+        image_width = st.number_input("画像の最大幅 (px)", 160, 1920, EXCEL_IMAGE_MAX_SIZE[0], step=80, help="表示は320x240の枠です。Excelで拡大して見たい場合は大きくしてください（ファイルも大きくなります）")
+    # 縦横比4:3で最大サイズを決める（表示は320x240の枠に収まる）
+    excel_image_options = {
+        "image_format": image_format,
+        "image_quality": image_quality,
+        "image_size": (int(image_width), int(image_width) * 3 // 4),
+    }
+
+# --- 7.5 編集画面の部品（フラグメント：操作した部品だけを再実行する） ---
+def invalidate_excel_export():
+    # 作成済みのExcelは内容が古くなるので破棄し、ダウンロードボタンを消すためにアプリ全体を再実行する
+    if st.session_state.get("excel_export") is not None:
+        st.session_state.excel_export = None
+        st.rerun()
+
+@st.fragment
+def render_step_editor(i, video_path, frame_strip, keyframe_index):
+    if st.session_state.pop("excel_export_dropped", False):
+        st.rerun()
+    step = st.session_state.manual_steps[i]
+    before = (clean_timestamp(step.get('timestamp', 0)), step.get('title'), step.get('text'))
+    with st.container():
+        st.markdown(f"#### 手順 {i+1}")
+        c1, c2 = st.columns([1.5, 1])
+        with c1:
+            ts = clean_timestamp(step.get('timestamp', 0))
+            new_ts = st.number_input(f"秒数 #{i+1}", value=ts, step=0.1, format="%.1f", key=f"ts_{i}")
+            if keyframe_index is not None:
+                candidates = keyframe_index.candidates(new_ts)
+                kf_cols = st.columns(len(candidates) + 1)
+                kf_cols[0].button("🧲 スナップ", key=f"snap_{i}", on_click=set_step_timestamp, args=(i, keyframe_index.nearest(new_ts)), help="最も近いキーフレームに合わせます")
+                for j, (col, candidate) in enumerate(zip(kf_cols[1:], candidates)):
+                    # 候補の見た目はサムネイル列から出す（デコードしない）
+                    thumb = frame_strip.frame_at(candidate) if frame_strip is not None else None
+                    if thumb is not None: col.image(thumb, use_container_width=True)
+                    col.button(f"{candidate:.1f}秒", key=f"kf_{i}_{j}", on_click=set_step_timestamp, args=(i, candidate))
+            # プレビューはサムネイル列から取り出し、フル解像度のデコードはExcel出力時だけにする
+            # 長い動画ではサムネイルの間隔が0.1秒より粗くなるので、半刻みより離れた枠しか無ければ動画から取り出す
+            img = frame_strip.frame_at(new_ts, tolerance=STRIP_INTERVAL / 2) if frame_strip is not None else None
+            if img is None: img = extract_frame_as_pil(video_path, new_ts)
+            if img is not None: st.image(img, use_container_width=True)
+            step['timestamp'] = new_ts
+        with c2:
+            step['title'] = st.text_input(f"見出し #{i+1}", step['title'], key=f"ti_{i}")
+            step['text'] = st.text_area(f"説明 #{i+1}", step['text'], height=150, key=f"tx_{i}")
+            narration = get_narration_cache()
+            audio_path = narration.lookup(step['text'])
+            if audio_path: st.audio(audio_path, format=narration.backend.mime)
+        st.divider()
+    if (step['timestamp'], step['title'], step['text']) != before:
+        invalidate_excel_export()
+
+@st.fragment
+def render_drawing_editor(video_path):
+    steps = st.session_state.manual_steps
+    step_options = [f"手順 {i+1}: {s['title']}" for i, s in enumerate(steps)]
+    selected_option = st.selectbox("編集する画像を選択:", step_options)
+    selected_index = step_options.index(selected_option)
+    
+    t1, t2, t3 = st.columns([1,1,2])
+    with t1: mode = st.selectbox("ツール", ["rect", "circle", "line", "text", "transform"], key="draw_tool")
+    with t2: color = st.color_picker("色", "#FF0000", key="draw_color")
+    with t3: width = st.slider("太さ", 1, 10, 3, key="draw_width")
+
+    target_step = steps[selected_index]
+    ts = clean_timestamp(target_step.get('timestamp', 0))
+    bg_img = extract_frame_as_pil(video_path, ts)
+    
+    if bg_img:
+        display_img = bg_img.copy()
+        display_img.thumbnail((800, 800))
+        
+        # ★修正点：読み込むのは「描画データ(drawing_state)」にする（画像データではない）
+        initial_data_json = target_step.get('drawing_state')
+        
+        canvas_result = st_canvas(
+            fill_color="rgba(255, 165, 0, 0.1)",
+            stroke_width=width, stroke_color=color,
+            background_image=display_img,
+            update_streamlit=True,
+            width=CANVAS_WIDTH,
+            height=CANVAS_HEIGHT,
+            drawing_mode=mode,
+            # ★修正点：JSONデータを渡す（なければNone）
+            initial_drawing=initial_data_json if initial_data_json else None,
+            key=f"canvas_editor_{selected_index}",
+            display_toolbar=True,
+        )
+        
+        # 保存するのは描画データ(JSON)だけ。画像への焼き込みはExcel出力時に出力サイズで行う
+        # 何も描いていないキャンバスも {"objects": [], ...} を返すので None に揃え、図形(objects)だけで変化を判定する
+        if canvas_result.json_data is not None:
+            drawing = canvas_result.json_data if canvas_result.json_data.get("objects") else None
+            if (drawing or {}).get("objects") != (target_step.get('drawing_state') or {}).get("objects"):
+                steps[selected_index]['drawing_state'] = drawing
+                invalidate_excel_export()
+
 # --- 8. メインエリア ---
 st.title("📜 Nano Factory AI")
 st.markdown("""<p style='font-size: 1.3rem; font-weight: bold; color: #555; margin-bottom: 20px;'>動画からマニュアルを自動生成・編集・Excel出力まで一気通貫で行います。</p>""", unsafe_allow_html=True)
@@ -360,60 +375,87 @@ st.markdown("""<div style='font-size: 1.3rem; font-weight: bold; margin-bottom:
 if "edit_mode" not in st.session_state: st.session_state.edit_mode = "list"
 if "manual_steps" not in st.session_state: st.session_state.manual_steps = None
 if "last_uploaded_file" not in st.session_state: st.session_state.last_uploaded_file = None
+if "session_id" not in st.session_state: st.session_state.session_id = uuid.uuid4().hex
+if "video_path" not in st.session_state: st.session_state.video_path = None
+if "analysis_job_id" not in st.session_state: st.session_state.analysis_job_id = None
+if "analysis_error" not in st.session_state: st.session_state.analysis_error = None
+if "analysis_notice" not in st.session_state: st.session_state.analysis_notice = None
 
 uploaded_file = st.file_uploader("動画アップロード", type=["mp4", "mov"], label_visibility="collapsed")
+video_store = get_video_store()
+
+if not uploaded_file and st.session_state.video_path:
+    video_store.release(st.session_state.session_id)
+    st.session_state.video_path = None
 
 if uploaded_file:
     # 動画切り替え時のリセット処理
-    if st.session_state.last_uploaded_file != uploaded_file.name:
+    upload_key = getattr(uploaded_file, "file_id", None) or f"{uploaded_file.name}:{uploaded_file.size}"
+    if st.session_state.last_uploaded_file != upload_key or not os.path.exists(st.session_state.video_path or ""):
         st.session_state.manual_steps = None
         st.session_state.edit_mode = "list"
-        st.session_state.last_uploaded_file = uploaded_file.name
-        temp_filename = "temp_video.mp4"
-        with open(temp_filename, "wb") as f:
-            while True:
-                chunk = uploaded_file.read(1024*1024)
-                if not chunk: break
-                f.write(chunk)
+        st.session_state.last_uploaded_file = upload_key
+        st.session_state.analysis_job_id = None
+        st.session_state.analysis_error = None
+        st.session_state.analysis_notice = None
+        with st.spinner("動画を保存中..."):
+            st.session_state.video_digest, st.session_state.video_path = video_store.put_stream(uploaded_file, os.path.splitext(uploaded_file.name)[1])
+        video_store.acquire(st.session_state.session_id, st.session_state.video_path)
+        video_store.evict()
     else:
-        temp_filename = "temp_video.mp4"
+        video_store.acquire(st.session_state.session_id, st.session_state.video_path)
+    video_path = st.session_state.video_path
+
+    # ブラウザを再読み込みしても、同じ動画の解析が実行中ならそのジョブに再接続する
+    if api_key and st.session_state.analysis_job_id is None and st.session_state.manual_steps is None:
+        running_job = get_job_manager().find_active(st.session_state.video_digest, api_key)
+        if running_job is not None:
+            st.session_state.analysis_job_id = running_job.job_id
 
     # --- 画面表示 ---
     if st.session_state.edit_mode == "list":
         # === モード1：リスト表示 & 秒数調整 ===
         st.subheader("🎥 現場動画（元データ）")
-        st.video(temp_filename)
+        st.video(video_path)
         st.divider()
 
-        if st.button("AI解析を実行する", type="primary"):
+        use_proxy = st.checkbox("⚡ 軽量プロキシで解析する（長い動画は区間に分けて並列解析）", value=False)
+        reanalyze = st.checkbox("♻️ 前回の解析結果を使わずに再解析する", value=False)
+        if st.session_state.analysis_job_id:
+            render_analysis_job(st.session_state.analysis_job_id, video_path)
+        elif st.button("AI解析を実行する", type="primary"):
             if not api_key:
                 st.error("⚠️ APIキーが必要です")
             else:
-                with st.spinner("AI解析中..."):
-                    steps = process_video_with_gemini(temp_filename, api_key, final_model_name)
-                    if steps:
-                        st.session_state.manual_steps = steps
-                        st.rerun()
+                job = get_job_manager().submit(video_path, api_key, final_model_name, st.session_state.video_digest, use_cache=not reanalyze, use_proxy=use_proxy, fallback_models=fallback_models)
+                st.session_state.analysis_job_id = job.job_id
+                st.session_state.analysis_error = None
+                st.session_state.analysis_notice = None
+                st.rerun()
+        if st.session_state.analysis_error:
+            st.error(st.session_state.analysis_error)
+        if st.session_state.analysis_notice:
+            st.info(st.session_state.analysis_notice)
 
         if st.session_state.manual_steps:
             st.subheader("📝 編集 & プレビュー")
             st.info("秒数を調整して、ベストな画像を選んでください。お絵かきは「次へ」ボタンを押してから行います。")
             
+            frame_strip = None
+            keyframe_index = None
+            if os.path.exists(keyframe_index_path(video_path)):
+                frame_strip = get_frame_strip(video_path)
+                keyframe_index = get_keyframe_index(video_path)
+            elif st.button("🔍 プレビュー索引を作成（高速プレビュー & キーフレーム候補）"):
+                with st.spinner("動画を読み込んでプレビュー用の索引を作成しています..."):
+                    frame_strip = get_frame_strip(video_path)
+                    keyframe_index = get_keyframe_index(video_path)
+
             steps = st.session_state.manual_steps
-            for i, step in enumerate(steps):
-                with st.container():
-                    st.markdown(f"#### 手順 {i+1}")
-                    c1, c2 = st.columns([1.5, 1])
-                    with c1:
-                        ts = clean_timestamp(step.get('timestamp', 0))
-                        new_ts = st.number_input(f"秒数 #{i+1}", value=ts, step=0.1, format="%.1f", key=f"ts_{i}")
-                        img = extract_frame_as_pil(temp_filename, new_ts)
-                        if img: st.image(img, use_container_width=True)
-                        steps[i]['timestamp'] = new_ts
-                    with c2:
-                        steps[i]['title'] = st.text_input(f"見出し #{i+1}", step['title'], key=f"ti_{i}")
-                        steps[i]['text'] = st.text_area(f"説明 #{i+1}", step['text'], height=150, key=f"tx_{i}")
-                    st.divider()
+            if st.button("🔊 ナレーション音声を作成（全手順）"):
+                generate_all_narrations(steps)
+            for i in range(len(steps)):
+                render_step_editor(i, video_path, frame_strip, keyframe_index)
             
             col_btn1, col_btn2 = st.columns(2)
             with col_btn1:
@@ -421,8 +463,7 @@ if uploaded_file:
                     st.session_state.edit_mode = "draw"
                     st.rerun()
             with col_btn2:
-                excel_data = create_excel_file(steps, manual_number, author_name, create_date, temp_filename)
-                st.download_button("📥 そのままExcel出力", excel_data, f"{manual_number}.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", use_container_width=True)
+                render_excel_download(steps, manual_number, author_name, create_date, video_path, excel_image_options, "📥 そのままExcel出力", key="list_export")
 
     elif st.session_state.edit_mode == "draw":
         # === モード2：お絵かき集中モード ===
@@ -430,44 +471,7 @@ if uploaded_file:
         st.info("1枚ずつ選択して、矢印や枠線を描き込んでください。")
         
         steps = st.session_state.manual_steps
-        step_options = [f"手順 {i+1}: {s['title']}" for i, s in enumerate(steps)]
-        selected_option = st.selectbox("編集する画像を選択:", step_options)
-        selected_index = step_options.index(selected_option)
-        
-        t1, t2, t3 = st.columns([1,1,2])
-        with t1: mode = st.selectbox("ツール", ["rect", "circle", "line", "text", "transform"], key="draw_tool")
-        with t2: color = st.color_picker("色", "#FF0000", key="draw_color")
-        with t3: width = st.slider("太さ", 1, 10, 3, key="draw_width")
-
-        target_step = steps[selected_index]
-        ts = clean_timestamp(target_step.get('timestamp', 0))
-        bg_img = extract_frame_as_pil(temp_filename, ts)
-        
-        if bg_img:
-            display_img = bg_img.copy()
-            display_img.thumbnail((800, 800))
-            
-            # ★修正点：読み込むのは「描画データ(drawing_state)」にする（画像データではない）
-            initial_data_json = target_step.get('drawing_state')
-            
-            canvas_result = st_canvas(
-                fill_color="rgba(255, 165, 0, 0.1)",
-                stroke_width=width, stroke_color=color,
-                background_image=display_img,
-                update_streamlit=True,
-                height=400,
-                drawing_mode=mode,
-                # ★修正点：JSONデータを渡す（なければNone）
-                initial_drawing=initial_data_json if initial_data_json else None,
-                key=f"canvas_editor_{selected_index}",
-                display_toolbar=True,
-            )
-            
-            # ★修正点：保存するときに「画像データ」と「描画データ」を両方保存する
-            if canvas_result.image_data is not None:
-                steps[selected_index]['edited_image_data'] = canvas_result.image_data
-            if canvas_result.json_data is not None:
-                steps[selected_index]['drawing_state'] = canvas_result.json_data
+        render_drawing_editor(video_path)
 
         st.divider()
         c1, c2 = st.columns(2)
@@ -476,6 +480,38 @@ if uploaded_file:
                 st.session_state.edit_mode = "list"
                 st.rerun()
         with c2:
-            excel_data = create_excel_file(steps, manual_number, author_name, create_date, temp_filename)
-            st.download_button("📥 編集完了！Excelをダウンロード", excel_data, f"{manual_number}.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", type="primary", use_container_width=True)
+            render_excel_download(steps, manual_number, author_name, create_date, video_path, excel_image_options, "📥 編集完了！Excelをダウンロード", key="draw_export", type="primary")
 
+# --- 9. パフォーマンス表示（このセッションの処理時間） ---
+with st.sidebar:
+    st.divider()
+    with st.expander("⏱️ パフォーマンス"):
+        recorder = st.session_state.perf_recorder
+        summary = recorder.summary()
+        if summary:
+            st.dataframe(
+                [
+                    {
+                        "処理": row["stage"],
+                        "回数": row["calls"],
+                        "合計(秒)": round(row["total_s"], 2),
+                        "平均(秒)": round(row["avg_s"], 3),
+                        "最大(秒)": round(row["max_s"], 3),
+                        "MB": round(row["bytes"] / 1024 ** 2, 2),
+                        "件数": row["count"],
+                        "エラー": row["errors"],
+                    }
+                    for row in summary
+                ],
+                hide_index=True,
+                use_container_width=True,
+            )
+            st.caption("直近の記録")
+            st.json(list(recorder.records)[-20:], expanded=False)
+            c1, c2 = st.columns(2)
+            c1.button("🔄 更新", key="perf_refresh", use_container_width=True)
+            if c2.button("🧹 クリア", key="perf_clear", use_container_width=True):
+                recorder.clear()
+                st.rerun()
+        else:
+            st.caption("まだ計測結果がありません。")
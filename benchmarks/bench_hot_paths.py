@@ -0,0 +1,274 @@
+# 重い処理（フレーム抽出・描き込み合成・Excel出力・解析全体）のベンチマーク
+# 合成した動画と、Gemini APIを真似たローカルの偽物を使うので、ネットワーク無しで再現できる
+# 使い方:
+#   python benchmarks/bench_hot_paths.py --json result.json
+#   python benchmarks/bench_hot_paths.py --baseline result.json   # 前回より遅くなった項目があれば終了コード1
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import statistics
+import tracemalloc
+import contextlib
+
+# 動画ストア等の保存先はインポート時に決まるので、manual_core より先に作業用フォルダへ向ける
+WORK_DIR = os.environ.get("NANO_FACTORY_BENCH_DIR") or os.path.join(tempfile.gettempdir(), "nano_factory_bench")
+os.environ["NANO_FACTORY_VIDEO_STORE"] = os.path.join(WORK_DIR, "store")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cv2
+import numpy as np
+import openpyxl
+import PIL
+import manual_core
+
+# --- 1. 合成動画 ---
+# (名前, 幅, 高さ, 秒数, fps)
+VIDEO_PROFILES = [
+    ("360p_10s", 640, 360, 10, 30),
+    ("720p_30s", 1280, 720, 30, 30),
+    ("1080p_20s", 1920, 1080, 20, 30),
+]
+QUICK_PROFILES = [("360p_5s", 640, 360, 5, 30)]
+SCENE_SECONDS = 2.5  # この間隔で背景色を切り替え、シーンの変わり目を作る
+
+def make_synthetic_video(path, width, height, seconds, fps):
+    # 乱数の種を固定した動く図形とフレーム番号を描く。作成済みなら作り直さない
+    if os.path.exists(path): return path
+    rng = np.random.default_rng(0)
+    part_path = path + ".part.mp4"
+    writer = cv2.VideoWriter(part_path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    noise = rng.integers(0, 40, (height, width, 3), dtype=np.uint8)
+    for i in range(int(seconds * fps)):
+        scene = int(i / fps / SCENE_SECONDS)
+        frame = np.full((height, width, 3), ((scene * 70) % 256, (scene * 40 + 80) % 256, 120), np.uint8)
+        frame += noise
+        x = int((i * 7) % max(1, width - height // 4))
+        cv2.rectangle(frame, (x, height // 3), (x + height // 4, height // 3 + height // 4), (255, 255, 255), -1)
+        cv2.putText(frame, str(i), (20, height // 6), cv2.FONT_HERSHEY_SIMPLEX, height / 240, (0, 0, 0), max(1, height // 120))
+        writer.write(frame)
+    writer.release()
+    os.replace(part_path, path)
+    return path
+
+# --- 2. Gemini APIの偽物 ---
+class FakeFile:
+    def __init__(self, name, state):
+        self.name = name
+        self.state = type("State", (), {"name": state})()
+        self.expiration_time = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=48)
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+class FakeGenAI:
+    # upload_file / get_file / GenerativeModel.generate_content を、決まった手順JSONを返す偽物に置き換える
+    # upload_delay: アップロード1回の待ち時間、processing_polls: ACTIVEになるまでのget_file回数、
+    # first_chunk_delay: 最初のチャンクまでの待ち、generate_delay: 残りのチャンクを返し終えるまでの待ち
+    def __init__(self, steps, upload_delay=0.2, processing_polls=1, first_chunk_delay=0.5, generate_delay=1.0, chunk_size=64):
+        self.steps = steps
+        self.upload_delay = upload_delay
+        self.processing_polls = processing_polls
+        self.first_chunk_delay = first_chunk_delay
+        self.generate_delay = generate_delay
+        self.chunk_size = chunk_size
+        self.polls = {}
+        self.calls = {"upload_file": 0, "get_file": 0, "generate_content": 0}
+
+    def upload_file(self, path, **kwargs):
+        self.calls["upload_file"] += 1
+        time.sleep(self.upload_delay)
+        name = f"files/bench-{len(self.polls)}"
+        self.polls[name] = 0
+        return FakeFile(name, "PROCESSING" if self.processing_polls else "ACTIVE")
+
+    def get_file(self, name):
+        self.calls["get_file"] += 1
+        if name not in self.polls: raise KeyError(name)
+        self.polls[name] += 1
+        return FakeFile(name, "ACTIVE" if self.polls[name] >= self.processing_polls else "PROCESSING")
+
+    def GenerativeModel(self, model_name):
+        fake = self
+
+        class Model:
+            def generate_content(self, contents, stream=False, **kwargs):
+                fake.calls["generate_content"] += 1
+                text = json.dumps(fake.steps, ensure_ascii=False)
+                chunks = [text[i:i + fake.chunk_size] for i in range(0, len(text), fake.chunk_size)]
+
+                def iterate():
+                    time.sleep(fake.first_chunk_delay)
+                    for chunk in chunks:
+                        yield FakeChunk(chunk)
+                        time.sleep(fake.generate_delay / len(chunks))
+                if stream: return iterate()
+                return FakeChunk("".join(chunk.text for chunk in iterate()))
+        return Model()
+
+    @contextlib.contextmanager
+    def installed(self, poll_interval=0.05):
+        # APIキーごとのクライアントをこの偽物に差し替え、終わったら元に戻す
+        saved_client = manual_core.get_gemini_client
+        saved_poll = manual_core.POLL_INITIAL_INTERVAL
+        manual_core.get_gemini_client = lambda api_key: self
+        manual_core.POLL_INITIAL_INTERVAL = poll_interval
+        try:
+            yield self
+        finally:
+            manual_core.get_gemini_client = saved_client
+            manual_core.POLL_INITIAL_INTERVAL = saved_poll
+
+def canned_steps(duration, count=12):
+    return [
+        {"title": f"手順{i + 1}", "text": f"部品{i + 1}を取り付け、ボルトを規定トルクで締めます。", "timestamp": round(duration * (i + 0.5) / count, 1)}
+        for i in range(count)
+    ]
+
+def sample_drawing():
+    # 矩形・円・線・文字・手書きの5種類を描いた状態（キャンバス座標）
+    return {"objects": [
+        {"type": "rect", "left": 40, "top": 60, "width": 180, "height": 120, "stroke": "#FF0000", "strokeWidth": 3, "fill": "rgba(0,0,0,0)"},
+        {"type": "circle", "left": 300, "top": 100, "radius": 50, "stroke": "#00AAFF", "strokeWidth": 4, "fill": ""},
+        {"type": "line", "left": 100, "top": 250, "x1": -80, "y1": -30, "x2": 80, "y2": 30, "stroke": "#FFD700", "strokeWidth": 5},
+        {"type": "text", "left": 380, "top": 300, "text": "注意", "fontSize": 28, "fill": "#FF0000"},
+        {"type": "path", "left": 0, "top": 0, "stroke": "#00FF00", "strokeWidth": 3,
+         "path": [["M", 50, 350], ["Q", 120, 300, 200, 350], ["L", 260, 380]]},
+    ]}
+
+# --- 3. 計測 ---
+def reset_frame_caches():
+    # デコーダとフレームキャッシュを空にして、毎回コールド状態から測る
+    manual_core.get_frame_decoder.clear()
+    manual_core.get_frame_cache.clear()
+
+def measure(func, repeat, setup=None, track_memory=True):
+    # 時間はtracemallocを切った状態で測り、メモリのピークは別に1回だけ測る
+    timings = []
+    for _ in range(repeat):
+        if setup: setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    result = {"median_s": statistics.median(timings), "min_s": min(timings)}
+    if track_memory:
+        if setup: setup()
+        tracemalloc.start()
+        try:
+            func()
+            result["peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        finally:
+            tracemalloc.stop()
+    return result
+
+def bench_video(name, video_path, duration, args):
+    results = []
+    fps = cv2.VideoCapture(video_path).get(cv2.CAP_PROP_FPS) or 30.0
+    rng = random.Random(0)
+    random_times = [round(rng.uniform(0, duration - 1.0 / fps), 1) for _ in range(args.frames)]
+    steps = canned_steps(duration)
+
+    def add(bench, result, **extra):
+        results.append({"bench": bench, "video": name, **result, **extra})
+        peak = f"{result['peak_mb']:8.1f}MB" if "peak_mb" in result else " " * 10
+        notes = " ".join(f"{k}={v}" for k, v in extra.items())
+        print(f"  {bench:<28} 中央値 {result['median_s'] * 1000:9.1f}ms  最小 {result['min_s'] * 1000:9.1f}ms  {peak}  {notes}")
+
+    # 編集画面のプレビューと同じく、1枚ずつランダムな秒数を取り出す
+    add("extract_frame_random", measure(lambda: [manual_core.extract_frame_as_pil(video_path, t) for t in random_times], args.repeat, reset_frame_caches), frames=len(random_times))
+    # Excel出力と同じく、全手順の秒数をまとめて前方に読む
+    add("load_step_frames", measure(lambda: manual_core.load_step_frames(steps, video_path), args.repeat, reset_frame_caches), frames=len(steps))
+
+    frame = manual_core.load_step_frames(steps[:1], video_path)[0]
+    drawing = sample_drawing()
+    for image_format in manual_core.EXCEL_IMAGE_FORMATS:
+        add(f"composite_{image_format.lower()}", measure(lambda: manual_core.render_step_image(frame, drawing, image_format=image_format), args.repeat))
+
+    export_steps = [dict(step, drawing_state=drawing) for step in steps]
+    export_path = os.path.join(WORK_DIR, f"{name}.xlsx")
+    for image_format in manual_core.EXCEL_IMAGE_FORMATS:
+        def export():
+            manual_core.write_excel_file(export_path, export_steps, "SOP-BENCH", "bench", datetime.date(2024, 1, 1), video_path, image_format=image_format)
+        add(f"excel_export_{image_format.lower()}", measure(export, args.repeat, reset_frame_caches), kb=round(os.path.getsize(export_path) / 1024))
+
+    # 解析全体（アップロード→処理待ち→生成→手順JSON）。キャッシュもアップロード記録も使わない
+    fake = FakeGenAI(steps, args.upload_delay, args.processing_polls, args.first_chunk_delay, args.generate_delay)
+    for use_proxy in (False, True):
+        def analyze():
+            manual_core.get_upload_index.clear()
+            shutil.rmtree(os.environ["NANO_FACTORY_VIDEO_STORE"], ignore_errors=True)
+            result = manual_core.process_video_with_gemini(video_path, "BENCH-KEY", "gemini-bench", use_cache=False, use_proxy=use_proxy)
+            assert len(result) == len(steps), result
+        with fake.installed(args.poll_interval):
+            add("end_to_end_proxy" if use_proxy else "end_to_end", measure(analyze, args.repeat, track_memory=False))
+    return results
+
+# --- 4. 比較 ---
+def compare(results, baseline_path, threshold):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(r["bench"], r["video"]): r for r in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        base = baseline.get((result["bench"], result["video"]))
+        if not base: continue
+        for metric in ("median_s", "peak_mb"):
+            if metric in result and base.get(metric) and result[metric] > base[metric] * threshold:
+                regressions.append(f"{result['video']} {result['bench']} {metric}: {base[metric]:.4g} -> {result[metric]:.4g}")
+    return regressions
+
+def library_versions():
+    versions = {"python": platform.python_version(), "opencv": cv2.__version__, "numpy": np.__version__, "openpyxl": openpyxl.__version__, "pillow": PIL.__version__}
+    try:
+        import streamlit
+        versions["streamlit"] = streamlit.__version__
+    except ImportError:
+        pass
+    return versions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="フレーム抽出・合成・Excel出力・解析全体の処理時間とメモリを測ります。")
+    parser.add_argument("--quick", action="store_true", help="短い動画1本だけで測る（動作確認用）")
+    parser.add_argument("--repeat", type=int, default=3, help="各項目の繰り返し回数（中央値を採用）")
+    parser.add_argument("--frames", type=int, default=20, help="ランダム抽出するフレーム数")
+    parser.add_argument("--upload-delay", type=float, default=0.2, help="偽APIのアップロード待ち時間（秒）")
+    parser.add_argument("--processing-polls", type=int, default=1, help="偽APIで処理完了までに必要なget_file回数")
+    parser.add_argument("--poll-interval", type=float, default=0.05, help="処理待ちの最初のポーリング間隔（秒）")
+    parser.add_argument("--first-chunk-delay", type=float, default=0.5, help="偽APIの最初のチャンクまでの待ち時間（秒）")
+    parser.add_argument("--generate-delay", type=float, default=1.0, help="偽APIが残りを返し終えるまでの時間（秒）")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    parser.add_argument("--baseline", help="比較する前回の結果JSON")
+    parser.add_argument("--threshold", type=float, default=1.3, help="前回の何倍を超えたら劣化とみなすか")
+    args = parser.parse_args(argv)
+
+    video_dir = os.path.join(WORK_DIR, "videos")
+    os.makedirs(video_dir, exist_ok=True)
+    versions = library_versions()
+    print("ライブラリ:", ", ".join(f"{k} {v}" for k, v in versions.items()))
+
+    results = []
+    for name, width, height, seconds, fps in (QUICK_PROFILES if args.quick else VIDEO_PROFILES):
+        print(f"\n[{name}] {width}x{height} {seconds}秒 {fps}fps")
+        video_path = make_synthetic_video(os.path.join(video_dir, f"{name}.mp4"), width, height, seconds, fps)
+        results.extend(bench_video(name, video_path, seconds, args))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"created_at": datetime.datetime.now().isoformat(timespec="seconds"), "versions": versions, "results": results}, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.threshold)
+        if regressions:
+            print(f"\n⚠️ 前回の{args.threshold}倍を超えた項目:")
+            for line in regressions: print("  " + line)
+            return 1
+        print("\n前回からの劣化はありません。")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
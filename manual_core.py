@@ -0,0 +1,1766 @@
+# Nano Factory AI のコア処理（Streamlitに依存しない部分）
+# 画面(app.py)とバッチ処理用CLI(sop_batch.py)の両方から使う
+import os
+import re
+import sys
+import json
+import glob
+import math
+import time
+import uuid
+import random
+import datetime
+import wave
+import hashlib
+import mimetypes
+import shutil
+import tempfile
+import threading
+import functools
+import contextlib
+import contextvars
+import logging
+from io import BytesIO
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import cv2
+import numpy as np
+import google.generativeai as genai
+from google.generativeai import client as genai_client
+from google.generativeai.types import file_types
+from PIL import Image as PILImage, ImageColor, ImageDraw, ImageFont
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Font, Border, Side
+from openpyxl.drawing.image import Image as ExcelImage
+from google.generativeai.types import HarmCategory, HarmBlockThreshold
+
+# --- 0. 常駐リソースのキャッシュ ---
+def cached_resource(max_entries=None):
+    # st.cache_resource の代わり。モジュールはプロセス内で1度しか読み込まれないので、
+    # 画面の再実行をまたいで同じオブジェクトを使い回せる。作成中の同じキーは1回だけ作る
+    def decorator(func):
+        entries = OrderedDict()
+        key_locks = {}
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            with lock:
+                if args in entries:
+                    entries.move_to_end(args)
+                    return entries[args]
+                key_lock = key_locks.setdefault(args, threading.Lock())
+            with key_lock:
+                with lock:
+                    if args in entries: return entries[args]
+                value = func(*args)
+                with lock:
+                    entries[args] = value
+                    key_locks.pop(args, None)
+                    while max_entries and len(entries) > max_entries:
+                        entries.popitem(last=False)
+            return value
+
+        def clear():
+            with lock:
+                entries.clear()
+
+        wrapper.clear = clear
+        return wrapper
+    return decorator
+
+# --- 0.5 処理時間の計測 ---
+# 各処理をperf_stageで囲むと、所要時間・バイト数・件数を1行のJSONとしてログに出し、
+# 呼び出し元のセッションの記録先(PerfRecorder)にも追記する。記録先はcontextvarで持つ
+PERF_LOG_PATH = os.environ.get("NANO_FACTORY_PERF_LOG")  # "-" で標準エラー、それ以外はファイルパス
+PERF_MAX_RECORDS = 1000
+perf_logger = logging.getLogger("nano_factory.perf")
+_perf_recorder = contextvars.ContextVar("perf_recorder", default=None)
+
+def configure_perf_log(path):
+    handler = logging.StreamHandler(sys.stderr) if path == "-" else logging.FileHandler(path, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    perf_logger.addHandler(handler)
+    perf_logger.setLevel(logging.INFO)
+    perf_logger.propagate = False
+
+if PERF_LOG_PATH: configure_perf_log(PERF_LOG_PATH)
+
+class PerfRecorder:
+    def __init__(self, max_records=PERF_MAX_RECORDS):
+        self.records = deque(maxlen=max_records)
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def clear(self):
+        with self._lock:
+            self.records.clear()
+
+    def summary(self):
+        # 処理ごとに回数・合計/平均/最大時間・バイト数・件数をまとめる
+        with self._lock:
+            records = list(self.records)
+        stages = OrderedDict()
+        for record in records:
+            s = stages.setdefault(record["stage"], {"stage": record["stage"], "calls": 0, "total_s": 0.0, "max_s": 0.0, "bytes": 0, "count": 0, "errors": 0})
+            s["calls"] += 1
+            s["total_s"] += record["seconds"]
+            s["max_s"] = max(s["max_s"], record["seconds"])
+            s["bytes"] += record.get("bytes") or 0
+            s["count"] += record.get("count") or 0
+            if record.get("error"): s["errors"] += 1
+        for s in stages.values():
+            s["avg_s"] = s["total_s"] / s["calls"]
+        return sorted(stages.values(), key=lambda s: s["total_s"], reverse=True)
+
+def set_perf_recorder(recorder):
+    # 画面のように処理全体をwithで囲めない場合に、現在のコンテキストの記録先を差し替える
+    _perf_recorder.set(recorder)
+
+@contextlib.contextmanager
+def perf_recording(recorder):
+    token = _perf_recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _perf_recorder.reset(token)
+
+@contextlib.contextmanager
+def perf_stage(stage, **fields):
+    # with perf_stage("upload", bytes=size) as rec: ... のように使い、途中で rec["count"] などを足せる
+    record = {"stage": stage, **fields}
+    recorder = _perf_recorder.get()
+    if recorder is None and not perf_logger.isEnabledFor(logging.INFO):
+        yield record
+        return
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        record["seconds"] = round(time.perf_counter() - start, 4)
+        record["ts"] = round(time.time(), 3)
+        record["thread"] = threading.current_thread().name
+        if recorder is not None: recorder.add(record)
+        perf_logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    # ワーカースレッドにも呼び出し元の記録先を引き継ぐ
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+# --- 1. データ処理用ヘルパー関数群 ---
+def clean_timestamp(ts_value):
+    if ts_value is None: return 0.0
+    if isinstance(ts_value, (int, float)): return float(ts_value)
+    s = str(ts_value).strip()
+    try:
+        return float(s)
+    except ValueError:
+        if ":" in s:
+            parts = s.split(":")
+            if len(parts) == 2:
+                try: return float(parts[0]) * 60 + float(parts[1])
+                except: pass
+        numbers = re.findall(r"\d+\.?\d*", s)
+        if numbers: return float(numbers[0])
+    return 0.0
+
+@contextlib.contextmanager
+def atomic_output(path, mode="wb", **open_kwargs):
+    # 同じフォルダの一時ファイルに書き、書き終えてから置き換える。途中で失敗したら一時ファイルを消す
+    fd, part_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".part")
+    try:
+        with os.fdopen(fd, mode, **open_kwargs) as f:
+            yield f
+        os.replace(part_path, path)
+    except BaseException:
+        if os.path.exists(part_path): os.remove(part_path)
+        raise
+
+
+# --- 2. フレームデコーダ（常駐 & LRUキャッシュ） ---
+FRAME_CACHE_MAX_BYTES = 512 * 1024 * 1024
+PREVIEW_MAX_SIZE = (960, 960)  # 画面表示用。キャッシュにはこの大きさで入れるので、4Kでも約1.5MB/枚で数百枚持てる
+SEEK_GRAB_LIMIT = 45  # この枚数以内の前方移動はシークせずgrab()で読み進める
+
+def get_video_identity(video_path):
+    stat = os.stat(video_path)
+    return f"{os.path.abspath(video_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+class FrameCache:
+    # (動画ID, フレーム番号, 縮小サイズ) -> RGB配列 のLRU。合計バイト数で上限管理する
+    def __init__(self, max_bytes=FRAME_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is not None:
+                self._frames.move_to_end(key)
+            return frame
+
+    def put(self, key, frame):
+        if frame.nbytes > self.max_bytes: return
+        frame.flags.writeable = False
+        with self._lock:
+            old = self._frames.pop(key, None)
+            if old is not None: self.total_bytes -= old.nbytes
+            self._frames[key] = frame
+            self.total_bytes += frame.nbytes
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self._frames.popitem(last=False)
+                self.total_bytes -= evicted.nbytes
+
+def fit_frame(frame, max_size):
+    # アスペクト比を保ったまま max_size (幅, 高さ) の枠に収める。拡大はしない
+    if max_size is None: return frame
+    height, width = frame.shape[:2]
+    scale = min(max_size[0] / width, max_size[1] / height)
+    if scale >= 1.0: return frame
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+class FrameDecoder:
+    # 動画1本につき1つ、VideoCaptureを開いたまま使い回す
+    def __init__(self, video_path, video_id, cache):
+        self.video_path = video_path
+        self.video_id = video_id
+        self.cache = cache
+        self.cap = cv2.VideoCapture(video_path)
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS) or 30.0
+        self.frame_count = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.next_index = 0  # 次のread()で得られるフレーム番号
+        self._lock = threading.Lock()
+
+    def frame_index(self, seconds):
+        # 末尾の半フレーム分は丸めると範囲外になるので、最後のフレームに収める
+        index = max(0, int(round(seconds * self.fps)))
+        return min(index, self.frame_count - 1) if self.frame_count > 0 else index
+
+    def _decode_at(self, index):
+        gap = index - self.next_index
+        if self.next_index < 0 or gap < 0 or gap > SEEK_GRAB_LIMIT:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+        else:
+            for _ in range(gap):
+                if not self.cap.grab():
+                    self.next_index = -1  # 位置が不明なので次回は必ずシークさせる
+                    return None
+        ret, frame = self.cap.read()
+        if not ret:
+            self.next_index = -1  # 位置が不明なので次回は必ずシークさせる
+            return None
+        self.next_index = index + 1
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+    def read_frames(self, seconds_list, max_size=PREVIEW_MAX_SIZE):
+        # キャッシュに無いフレームだけをフレーム番号順（前方のみ）に読み出す。
+        # 原寸のフレームはデコード直後にmax_sizeへ縮小し、縮小後のものだけをキャッシュする
+        indexes = [self.frame_index(s) for s in seconds_list]
+        frames = {}
+        missing = set()
+        for index in indexes:
+            frame = self.cache.get((self.video_id, index, max_size))
+            if frame is None: missing.add(index)
+            else: frames[index] = frame
+        if missing:
+            with self._lock, perf_stage("decode_frames", count=len(missing), cached=len(indexes) - len(missing)):
+                for index in sorted(missing):
+                    frame = self._decode_at(index)
+                    if frame is not None:
+                        frame = fit_frame(frame, max_size)
+                        self.cache.put((self.video_id, index, max_size), frame)
+                        frames[index] = frame
+        return [frames.get(index) for index in indexes]
+
+    def read_frame(self, seconds, max_size=PREVIEW_MAX_SIZE):
+        return self.read_frames([seconds], max_size)[0]
+
+def iter_sampled_frames(video_path, fps):
+    # 先頭から順に読み、fps間隔でサンプリングしたフレーム(BGR)を (秒数, フレーム) で返す
+    cap = cv2.VideoCapture(video_path)
+    src_fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    frame_index = 0
+    next_sample = 0.0
+    try:
+        while cap.grab():
+            t = frame_index / src_fps
+            frame_index += 1
+            if t + 1e-6 < next_sample: continue
+            next_sample += 1.0 / fps
+            ret, frame = cap.retrieve()
+            if ret: yield t, frame
+    finally:
+        cap.release()
+
+@cached_resource()
+def get_frame_cache():
+    return FrameCache()
+
+@cached_resource(max_entries=8)
+def get_frame_decoder(video_path, video_id):
+    return FrameDecoder(video_path, video_id, get_frame_cache())
+
+@perf_stage("extract_frame")
+def extract_frame_as_pil(video_path, seconds, max_size=PREVIEW_MAX_SIZE):
+    decoder = get_frame_decoder(video_path, get_video_identity(video_path))
+    frame = decoder.read_frame(seconds, max_size)
+    if frame is not None:
+        return PILImage.fromarray(frame)
+    return None
+
+
+# --- 3. 動画ストア（内容ハッシュで保存・重複排除・自動削除） ---
+VIDEO_STORE_DIR = os.environ.get("NANO_FACTORY_VIDEO_STORE", ".video_store")
+VIDEO_STORE_MAX_BYTES = 10 * 1024 ** 3
+VIDEO_STORE_MAX_AGE = 24 * 3600  # 秒。使われていない動画はこの時間で削除対象
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+PROXY_DIR = os.path.join(VIDEO_STORE_DIR, "proxy")
+VIDEO_EXTENSIONS = ("mp4", "mov")
+VIDEO_FILE_PATTERN = re.compile(r"^[0-9a-f]{64}\.(mp4|mov)$")
+SIDECAR_SUFFIXES = (".strip.u8", ".strip.json", ".keyframes.npz")  # 動画ごとのサムネイル列とキーフレーム索引
+
+def hash_stream(stream, sink=None):
+    digest = hashlib.sha256()
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk: break
+        digest.update(chunk)
+        if sink is not None: sink.write(chunk)
+    return digest.hexdigest()
+
+def video_digest_of(path):
+    return os.path.basename(path).split(".", 1)[0]
+
+class VideoStore:
+    # 動画は内容ハッシュ1つにつき1ファイルだけ保存し、セッションごとの参照(ハンドル)を管理する。
+    # 拡張子は再生・アップロード時の形式判定用に、最初に届いたものをファイル名に残す
+    def __init__(self, root, max_bytes=VIDEO_STORE_MAX_BYTES, max_age=VIDEO_STORE_MAX_AGE):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.handles = {}    # session_id -> (path, 最終アクセス時刻)
+        self.last_used = {}  # path -> 最終アクセス時刻
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def find(self, digest):
+        # 拡張子が違っても中身が同じなら同じファイルを返す
+        for ext in VIDEO_EXTENSIONS:
+            path = os.path.join(self.root, f"{digest}.{ext}")
+            if os.path.exists(path): return path
+        return None
+
+    def put_stream(self, stream, ext):
+        ext = ext.lower().lstrip(".")
+        if ext not in VIDEO_EXTENSIONS: ext = "mp4"
+        # メモリ上のアップロードは先にハッシュだけ計算し、既にあればディスクへ書かない
+        digest = None
+        if stream.seekable():
+            stream.seek(0)
+            digest = hash_stream(stream)
+            with self._lock:
+                path = self.find(digest)
+            if path is not None:
+                return digest, path
+            stream.seek(0)
+        # ハッシュ済みならそのままコピーし、それ以外は受け取りながらハッシュと書き込みを1回で行う。
+        # 既に同じ内容があれば書いた一時ファイルを捨てる
+        fd, part_path = tempfile.mkstemp(dir=self.root, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if digest is None: digest = hash_stream(stream, sink=f)
+                else: shutil.copyfileobj(stream, f, UPLOAD_CHUNK_SIZE)
+            with self._lock:
+                path = self.find(digest)
+                if path is not None:
+                    os.remove(part_path)
+                else:
+                    path = os.path.join(self.root, f"{digest}.{ext}")
+                    os.replace(part_path, path)
+        except Exception:
+            if os.path.exists(part_path): os.remove(part_path)
+            raise
+        return digest, path
+
+    def acquire(self, session_id, path):
+        now = time.time()
+        with self._lock:
+            self.handles[session_id] = (path, now)
+            self.last_used[path] = now
+
+    def release(self, session_id):
+        with self._lock:
+            self.handles.pop(session_id, None)
+
+    def evict(self):
+        now = time.time()
+        with self._lock:
+            # 一定時間アクセスの無いハンドルは閉じられたセッションとみなす
+            for session_id, (_, used_at) in list(self.handles.items()):
+                if now - used_at > self.max_age: del self.handles[session_id]
+            in_use_digests = {video_digest_of(path) for path, _ in self.handles.values()}
+            entries = []
+            for name in os.listdir(self.root):
+                path = os.path.join(self.root, name)
+                try: stat = os.stat(path)
+                except OSError: continue
+                if name.endswith(".part"):
+                    if now - stat.st_mtime > self.max_age: os.remove(path)
+                    continue
+                if not VIDEO_FILE_PATTERN.match(name): continue
+                # サムネイル列（最大1GiB）やプロキシも容量の上限に含めて、動画ごとの合計で判定する
+                size = stat.st_size + sum(os.path.getsize(p) for p in self.sidecar_paths(video_digest_of(path)))
+                entries.append((max(stat.st_mtime, self.last_used.get(path, 0)), size, path))
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+            for used_at, size, path in entries:
+                # 同じ内容の動画をどこかのセッションが使っている間は、付随ファイルも含めて何も消さない
+                digest = video_digest_of(path)
+                if digest in in_use_digests: continue
+                if now - used_at <= self.max_age and total <= self.max_bytes: continue
+                try: os.remove(path)
+                except OSError: continue
+                total -= size
+                self.last_used.pop(path, None)
+                # 索引やプロキシなど、同じ動画から作った付随ファイルも一緒に消す
+                for sidecar_path in self.sidecar_paths(digest):
+                    try: os.remove(sidecar_path)
+                    except OSError: pass
+
+    def sidecar_paths(self, digest):
+        paths = [os.path.join(self.root, digest + suffix) for suffix in SIDECAR_SUFFIXES]
+        paths += glob.glob(os.path.join(self.root, "proxy", f"{digest}_*"))
+        return [path for path in paths if os.path.exists(path)]
+
+@cached_resource()
+def get_video_store():
+    return VideoStore(VIDEO_STORE_DIR)
+
+# --- 4. プレビュー用サムネイル列（メモリマップ） ---
+STRIP_INTERVAL = 0.1  # 秒。number_inputの刻みに合わせる
+STRIP_WIDTH = 480
+STRIP_MIN_WIDTH = 160
+STRIP_MAX_BYTES = 1024 ** 3  # 長い動画はまず幅を縮め、それでも入らなければ間隔を広げてこの容量に収める
+
+def frame_strip_paths(video_path):
+    base = os.path.splitext(video_path)[0]
+    return base + ".strip.u8", base + ".strip.json"
+
+class FrameStrip:
+    # (枚数, 高さ, 幅, 3) のRGB配列を1つの連続したファイルとして持ち、np.memmapで参照する
+    def __init__(self, data_path, meta):
+        self.interval = meta["interval"]
+        self.frames = np.memmap(data_path, dtype=np.uint8, mode="r", shape=tuple(meta["shape"]))
+
+    def frame_at(self, seconds, tolerance=None):
+        # コピーせずにmemmapのスライスを返す。tolerance秒より離れた枠しか無ければNone
+        index = int(round(seconds / self.interval))
+        if tolerance is not None and abs(index * self.interval - seconds) > tolerance + 1e-6:
+            return None
+        if 0 <= index < len(self.frames):
+            return self.frames[index]
+        return None
+
+    @classmethod
+    @perf_stage("frame_strip_build")
+    def build(cls, video_path):
+        data_path, meta_path = frame_strip_paths(video_path)
+        cap = cv2.VideoCapture(video_path)
+        fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+        duration = cap.get(cv2.CAP_PROP_FRAME_COUNT) / fps
+        width = cap.get(cv2.CAP_PROP_FRAME_WIDTH) or STRIP_WIDTH
+        height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT) or STRIP_WIDTH
+        cap.release()
+        # 0.1秒刻みのまま容量に収まる幅を求め、STRIP_MIN_WIDTHまで縮めても足りない分だけ間隔を広げる
+        slots = max(1.0, duration / STRIP_INTERVAL)
+        fit_width = math.sqrt(STRIP_MAX_BYTES / slots / 3 * width / height)
+        strip_width = max(STRIP_MIN_WIDTH, min(STRIP_WIDTH, int(fit_width) // 2 * 2))
+        size = (strip_width, max(2, int(round(height * strip_width / width)) // 2 * 2))
+        frame_bytes = size[0] * size[1] * 3
+        interval = max(STRIP_INTERVAL, duration * frame_bytes / STRIP_MAX_BYTES)
+        capacity = int(duration / interval) + 2
+
+        part_path = data_path + ".part"
+        frames = np.memmap(part_path, dtype=np.uint8, mode="w+", shape=(capacity, size[1], size[0], 3))
+        count = 0
+        previous = None
+        for t, frame in iter_sampled_frames(video_path, 1.0 / interval):
+            index = int(round(t / interval))
+            if index >= capacity: break
+            small = cv2.cvtColor(cv2.resize(frame, size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2RGB)
+            # 元動画のfpsが枠の間隔より粗いと枠が飛ぶので、間の枠は直前のフレームで埋める（黒い枠を作らない）
+            if index > count: frames[count:index] = small if previous is None else previous
+            frames[index] = small
+            previous = small
+            count = index + 1
+        frames.flush()
+        del frames
+        if count == 0:
+            # 1枚もデコードできない動画（未対応のコーデック等）は空のファイルになりmmapできないので、
+            # 何も残さずに諦め、呼び出し側には動画から直接取り出させる
+            os.remove(part_path)
+            return None
+        os.truncate(part_path, count * frame_bytes)  # 実際のフレーム数が見積もりより少ない場合の余りを切り詰める
+        meta = {"interval": interval, "shape": [count, size[1], size[0], 3]}
+        os.replace(part_path, data_path)
+        write_json_atomic(meta_path, meta)
+        return cls(data_path, meta)
+
+    @classmethod
+    def load(cls, video_path):
+        data_path, meta_path = frame_strip_paths(video_path)
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if not meta["shape"][0]: return None
+        return cls(data_path, meta)
+
+@cached_resource(max_entries=8)
+def get_frame_strip(video_path):
+    # フレームを読めない動画では None を返す（プレビューは extract_frame_as_pil で取り出す）
+    if os.path.exists(frame_strip_paths(video_path)[1]):
+        return FrameStrip.load(video_path)
+    return FrameStrip.build(video_path)
+
+# --- 5. キーフレーム索引（シーン変化の検出 & 秒数のスナップ） ---
+KEYFRAME_SAMPLE_FPS = 4.0
+KEYFRAME_THUMB_SIZE = (64, 36)
+KEYFRAME_SMOOTHING = 5  # 動き量を平滑化するサンプル数
+KEYFRAME_MIN_GAP = 1.0  # シーン切り替わりとみなす間隔の下限（秒）
+
+def keyframe_index_path(video_path):
+    return os.path.splitext(video_path)[0] + ".keyframes.npz"
+
+class KeyframeIndex:
+    def __init__(self, times, scene_scores, motion_scores, keyframes):
+        self.times = times
+        self.scene_scores = scene_scores
+        self.motion_scores = motion_scores
+        self.keyframes = keyframes
+
+    @classmethod
+    @perf_stage("keyframe_index_build")
+    def build(cls, video_path, frame_strip=None):
+        # サムネイル列があればそこから間引いて使い、動画の再デコードを避ける
+        if frame_strip is not None:
+            stride = max(1, int(round(1.0 / (KEYFRAME_SAMPLE_FPS * frame_strip.interval))))
+            raw_samples = ((i * frame_strip.interval, frame_strip.frames[i], cv2.COLOR_RGB2GRAY) for i in range(0, len(frame_strip.frames), stride))
+        else:
+            raw_samples = ((t, frame, cv2.COLOR_BGR2GRAY) for t, frame in iter_sampled_frames(video_path, KEYFRAME_SAMPLE_FPS))
+        samples = [
+            (t, cv2.resize(cv2.cvtColor(frame, conversion), KEYFRAME_THUMB_SIZE, interpolation=cv2.INTER_AREA))
+            for t, frame, conversion in raw_samples
+        ]
+        if not samples:
+            return cls(np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0))
+        times = np.array([t for t, _ in samples], dtype=np.float64)
+        frames = np.stack([small for _, small in samples]).astype(np.float32) / 255.0
+
+        # シーン変化量: 隣り合うサンプルの平均絶対差。動き量: その移動平均
+        scene_scores = np.concatenate([[0.0], np.abs(np.diff(frames, axis=0)).mean(axis=(1, 2))])
+        kernel = np.ones(KEYFRAME_SMOOTHING) / KEYFRAME_SMOOTHING
+        motion_scores = np.convolve(scene_scores, kernel, mode="same")[:len(scene_scores)]  # サンプルが平滑化の幅より少ないと長く返るので揃える
+
+        # 平均+2σを超える局所最大をシーンの切り替わりとし、切り替わりで区切った各区間で最も動きの少ないフレームを候補にする
+        threshold = max(scene_scores.mean() + 2 * scene_scores.std(), 0.02)
+        padded = np.pad(scene_scores, 1)
+        peaks = np.flatnonzero((scene_scores > threshold) & (scene_scores >= padded[:-2]) & (scene_scores >= padded[2:]))
+        cuts = []
+        for peak in peaks:
+            if not cuts or times[peak] - times[cuts[-1]] >= KEYFRAME_MIN_GAP: cuts.append(peak)
+        bounds = [0] + cuts + [len(times)]
+        keyframes = [times[start + np.argmin(motion_scores[start:end])] for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+        return cls(times, scene_scores, motion_scores, np.array(keyframes))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["times"], data["scene_scores"], data["motion_scores"], data["keyframes"])
+
+    def save(self, path):
+        with atomic_output(path) as f:
+            np.savez_compressed(f, times=self.times, scene_scores=self.scene_scores, motion_scores=self.motion_scores, keyframes=self.keyframes)
+
+    def nearest(self, seconds):
+        if not len(self.keyframes): return seconds
+        return float(self.keyframes[np.argmin(np.abs(self.keyframes - seconds))])
+
+    def candidates(self, seconds, count=3):
+        if not len(self.keyframes): return []
+        order = np.argsort(np.abs(self.keyframes - seconds))[:count]
+        return sorted(float(self.keyframes[i]) for i in order)
+
+@cached_resource(max_entries=8)
+def get_keyframe_index(video_path):
+    # 索引ファイルがあれば読み込み、なければ作成して動画の隣に保存する
+    index_path = keyframe_index_path(video_path)
+    if os.path.exists(index_path):
+        return KeyframeIndex.load(index_path)
+    keyframe_index = KeyframeIndex.build(video_path, get_frame_strip(video_path))
+    keyframe_index.save(index_path)
+    return keyframe_index
+
+
+# --- 6. 描き込み（ベクターデータ）のラスタライズ ---
+CANVAS_WIDTH = 600
+CANVAS_HEIGHT = 400
+DRAWING_SUPERSAMPLE = 2  # 出力サイズの2倍で描いて縮小し、線のギザギザを抑える
+ELLIPSE_SEGMENTS = 72
+# 日本語の描き込みを書き出すためのCJKフォント（packages.txt の fonts-noto-cjk）。見つからなければPillow内蔵のフォント
+DRAWING_FONT_PATHS = [path for path in [os.environ.get("NANO_FACTORY_FONT")] if path] + [
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc",
+    "/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc",
+    "C:/Windows/Fonts/meiryo.ttc",
+]
+
+def parse_css_color(value, opacity=1.0):
+    if not value or value == "transparent": return None
+    match = re.match(r"rgba?\(([^)]*)\)", value.strip())
+    if match:
+        parts = [part.strip() for part in match.group(1).split(",")]
+        red, green, blue = (int(float(part)) for part in parts[:3])
+        alpha = float(parts[3]) if len(parts) > 3 else 1.0
+    else:
+        try: red, green, blue = ImageColor.getrgb(value)[:3]
+        except ValueError: return None
+        alpha = 1.0
+    return (red, green, blue, int(round(255 * alpha * opacity)))
+
+def _path_points(commands):
+    # fabric.jsのpath配列（M/L/Q/C/Z）を折れ線の点列にする
+    points = []
+    for command in commands:
+        op, args = command[0].upper(), command[1:]
+        if op in ("M", "L"):
+            points.append((args[0], args[1]))
+        elif op == "Q" and points:
+            (x0, y0), (x1, y1), (x2, y2) = points[-1], (args[0], args[1]), (args[2], args[3])
+            for k in range(1, 9):
+                t = k / 8
+                points.append(((1 - t) ** 2 * x0 + 2 * (1 - t) * t * x1 + t * t * x2, (1 - t) ** 2 * y0 + 2 * (1 - t) * t * y1 + t * t * y2))
+        elif op == "C" and points:
+            (x0, y0), (x1, y1), (x2, y2), (x3, y3) = points[-1], (args[0], args[1]), (args[2], args[3]), (args[4], args[5])
+            for k in range(1, 9):
+                t = k / 8
+                u = 1 - t
+                points.append((u ** 3 * x0 + 3 * u * u * t * x1 + 3 * u * t * t * x2 + t ** 3 * x3, u ** 3 * y0 + 3 * u * u * t * y1 + 3 * u * t * t * y2 + t ** 3 * y3))
+        elif op == "Z" and points:
+            points.append(points[0])
+    return points
+
+@functools.lru_cache(maxsize=32)
+def load_drawing_font(size):
+    for path in DRAWING_FONT_PATHS:
+        try: return ImageFont.truetype(path, size)
+        except OSError: continue
+    try: return ImageFont.load_default(size=size)
+    except TypeError: return ImageFont.load_default()
+
+def _draw_fabric_object(draw, obj, scale_x, scale_y):
+    kind = obj.get("type")
+    opacity = obj.get("opacity", 1) if obj.get("opacity") is not None else 1
+    stroke = parse_css_color(obj.get("stroke"), opacity)
+    fill = parse_css_color(obj.get("fill"), opacity)
+    stroke_width = (obj.get("strokeWidth") or 0) if stroke else 0
+    obj_scale_x = obj.get("scaleX") or 1
+    obj_scale_y = obj.get("scaleY") or 1
+    width = obj.get("width") or 0
+    height = obj.get("height") or 0
+
+    # left/topはoriginX/originYが指す点。そこから回転を考慮してオブジェクトの中心を求める
+    if obj.get("strokeUniform"):
+        box_w, box_h = width * obj_scale_x + stroke_width, height * obj_scale_y + stroke_width
+        line_width = stroke_width
+    else:
+        box_w, box_h = (width + stroke_width) * obj_scale_x, (height + stroke_width) * obj_scale_y
+        line_width = stroke_width * (obj_scale_x + obj_scale_y) / 2
+    angle = math.radians(obj.get("angle") or 0)
+    cos_a, sin_a = math.cos(angle), math.sin(angle)
+    dx = {"left": box_w / 2, "right": -box_w / 2}.get(obj.get("originX", "left"), 0)
+    dy = {"top": box_h / 2, "bottom": -box_h / 2}.get(obj.get("originY", "top"), 0)
+    center_x = (obj.get("left") or 0) + dx * cos_a - dy * sin_a
+    center_y = (obj.get("top") or 0) + dx * sin_a + dy * cos_a
+
+    def to_output(x, y):
+        # オブジェクト中心からの座標 → 出力画像の座標
+        x, y = x * obj_scale_x, y * obj_scale_y
+        return ((center_x + x * cos_a - y * sin_a) * scale_x, (center_y + x * sin_a + y * cos_a) * scale_y)
+
+    line_width = max(1, int(round(line_width * (scale_x + scale_y) / 2))) if stroke else 0
+    outline = None
+    closed = True
+    if kind == "rect":
+        outline = [to_output(x, y) for x, y in ((-width / 2, -height / 2), (width / 2, -height / 2), (width / 2, height / 2), (-width / 2, height / 2))]
+    elif kind in ("circle", "ellipse"):
+        radius_x = obj.get("rx") or obj.get("radius") or 0
+        radius_y = obj.get("ry") or obj.get("radius") or 0
+        outline = [
+            to_output(radius_x * math.cos(2 * math.pi * k / ELLIPSE_SEGMENTS), radius_y * math.sin(2 * math.pi * k / ELLIPSE_SEGMENTS))
+            for k in range(ELLIPSE_SEGMENTS)
+        ]
+    elif kind == "line":
+        outline = [to_output(obj.get("x1") or 0, obj.get("y1") or 0), to_output(obj.get("x2") or 0, obj.get("y2") or 0)]
+        closed, fill = False, None
+    elif kind in ("path", "polygon", "polyline"):
+        points = _path_points(obj.get("path") or []) if kind == "path" else [(p["x"], p["y"]) for p in obj.get("points") or []]
+        if not points: return
+        offset = obj.get("pathOffset")
+        if offset: offset_x, offset_y = offset["x"], offset["y"]
+        else:
+            xs, ys = [x for x, _ in points], [y for _, y in points]
+            offset_x, offset_y = (min(xs) + max(xs)) / 2, (min(ys) + max(ys)) / 2
+        outline = [to_output(x - offset_x, y - offset_y) for x, y in points]
+        closed = kind == "polygon"
+        if kind != "polygon": fill = None
+    elif kind in ("text", "i-text", "textbox"):
+        font_size = max(1, int((obj.get("fontSize") or 20) * obj_scale_y * scale_y))
+        draw.text(to_output(-width / 2, -height / 2), obj.get("text") or "", fill=fill or stroke, font=load_drawing_font(font_size))
+        return
+    if not outline: return
+    if fill and closed and len(outline) > 2:
+        draw.polygon(outline, fill=fill)
+    if stroke and line_width:
+        draw.line(outline + [outline[0]] if closed else outline, fill=stroke, width=line_width, joint="curve")
+
+def rasterize_drawing(drawing_state, size, canvas_size=(CANVAS_WIDTH, CANVAS_HEIGHT)):
+    # キャンバス座標のベクターデータを、出力サイズの透明レイヤーに直接描く
+    objects = (drawing_state or {}).get("objects") or []
+    if not objects: return None
+    work_size = (size[0] * DRAWING_SUPERSAMPLE, size[1] * DRAWING_SUPERSAMPLE)
+    layer = PILImage.new("RGBA", work_size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(layer, "RGBA")
+    scale_x = work_size[0] / canvas_size[0]
+    scale_y = work_size[1] / canvas_size[1]
+    for obj in objects:
+        _draw_fabric_object(draw, obj, scale_x, scale_y)
+    return layer.resize(size, PILImage.Resampling.LANCZOS)
+
+# --- 7. Excel作成関数 ---
+EXCEL_IMAGE_SIZE = (320, 240)
+EXCEL_IMAGE_FORMATS = ("JPEG", "PNG")
+EXCEL_IMAGE_FORMAT = "JPEG"
+EXCEL_IMAGE_QUALITY = 85
+EXCEL_IMAGE_MAX_SIZE = EXCEL_IMAGE_SIZE  # 既定は表示サイズと同じ。拡大して見たい場合は画面・CLIの設定で大きくする
+EXCEL_ROW_HEIGHT = 180
+EXPORT_WORKERS = 4
+EXPORT_DIR = os.path.join(VIDEO_STORE_DIR, "exports")
+EXPORT_MAX_FILES = 32
+
+def load_step_frames(steps, video_path, max_size=EXCEL_IMAGE_MAX_SIZE):
+    if not video_path: return [None] * len(steps)
+    timestamps = [clean_timestamp(step.get('timestamp', 0)) for step in steps]
+    decoder = get_frame_decoder(video_path, get_video_identity(video_path))
+    frames = decoder.read_frames([ts for ts in timestamps if ts >= 0], max_size=max_size)
+    frames.reverse()
+    return [frames.pop() if ts >= 0 else None for ts in timestamps]
+
+def render_step_image(frame, drawing_state, size=EXCEL_IMAGE_MAX_SIZE, image_format=EXCEL_IMAGE_FORMAT, image_quality=EXCEL_IMAGE_QUALITY):
+    # 先に出力サイズまで縮小し、描き込みはそのサイズでベクターから直接描いて合成する
+    with perf_stage("composite", format=image_format) as rec:
+        final_img = PILImage.fromarray(frame)
+        final_img.thumbnail(size)
+        try:
+            drawing_layer = rasterize_drawing(drawing_state, final_img.size)
+            if drawing_layer is not None:
+                final_img = PILImage.alpha_composite(final_img.convert("RGBA"), drawing_layer).convert("RGB")
+        except Exception as e:
+            print(f"Image merge error: {e}")
+        img_byte_arr = BytesIO()
+        if image_format == "JPEG":
+            final_img.convert("RGB").save(img_byte_arr, format="JPEG", quality=image_quality, optimize=True)
+        else:
+            final_img.save(img_byte_arr, format="PNG")
+        rec["bytes"] = img_byte_arr.tell()
+    return img_byte_arr.getvalue(), final_img.size
+
+def fit_display_size(size, box=EXCEL_IMAGE_SIZE):
+    # 埋め込む画素数とは別に、セル上の表示サイズは従来どおり320x240の枠に収める
+    scale = min(box[0] / size[0], box[1] / size[1], 1.0)
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+@perf_stage("excel_export")
+def write_excel_file(output, steps, m_num, m_author, m_date, video_path,
+                     image_format=EXCEL_IMAGE_FORMAT, image_quality=EXCEL_IMAGE_QUALITY, image_size=EXCEL_IMAGE_MAX_SIZE):
+    # write_onlyモードで行をそのまま一時ファイルへ流し、outputにはパスでもストリームでも直接保存する
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("作業手順書")
+
+    header_font = Font(bold=True, size=16)
+    meta_font = Font(size=11)
+    title_font = Font(bold=True, size=12)
+    normal_font = Font(size=11)
+    thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), 
+                         top=Side(style='thin'), bottom=Side(style='thin'))
+
+    def styled_cell(value=None, font=None, alignment=None, border=None):
+        cell = WriteOnlyCell(ws, value=value)
+        if font: cell.font = font
+        if alignment: cell.alignment = alignment
+        if border: cell.border = border
+        return cell
+
+    # 列幅は最初の行を書く前に決めておく必要がある
+    ws.column_dimensions['A'].width = 6
+    ws.column_dimensions['B'].width = 45
+    ws.column_dimensions['C'].width = 55
+    ws.merged_cells.add('A3:C3')
+
+    right = Alignment(horizontal='right')
+    center = Alignment(horizontal='center', vertical='center')
+    ws.append([styled_cell(f"No: {m_num}", Font(bold=True, size=11)), None,
+               styled_cell(f"作成日: {m_date.strftime('%Y/%m/%d')}", meta_font, right)])
+    ws.append([None, None, styled_cell(f"作成者: {m_author}", meta_font, right)])
+    ws.append([styled_cell("標準作業手順書", header_font, center)])
+    ws.append([])
+
+    start_row = 5
+    ws.append([styled_cell(label, title_font, center, thin_border) for label in ("No.", "作業画像", "作業内容・手順")])
+
+    # フレームは1回の前方パスでまとめて取り出し、合成と圧縮はスレッドで並列に行う。
+    # 全手順分を同時に持つので、読み出しながら出力サイズへ縮小しておく（4Kでも原寸は1枚ずつ）
+    frames = load_step_frames(steps, video_path, max_size=image_size)
+    executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS)
+    image_futures = [
+        submit_in_context(executor, render_step_image, frame, step.get('drawing_state'), image_size, image_format, image_quality) if frame is not None else None
+        for step, frame in zip(steps, frames)
+    ]
+    del frames
+
+    current_row = start_row + 1
+    text_alignment = Alignment(horizontal='left', vertical='top', wrap_text=True)
+    for i, step in enumerate(steps, 1):
+        ws.row_dimensions[current_row].height = EXCEL_ROW_HEIGHT
+        image_label = None
+        future = image_futures[i - 1]
+        if future is not None:
+            try:
+                data, size = future.result()
+                excel_img = ExcelImage(BytesIO(data))
+                excel_img.width, excel_img.height = fit_display_size(size)
+                excel_img.anchor = f'B{current_row}'
+                ws.add_image(excel_img)
+            except Exception:
+                image_label = "[画像処理エラー]"
+            # 圧縮済みの画像だけを残し、元のフレームと結果の参照は手放す
+            image_futures[i - 1] = None
+        else:
+            image_label = "[画像なし]"
+
+        ws.append([
+            styled_cell(i, alignment=center, border=thin_border),
+            styled_cell(image_label, border=thin_border),
+            styled_cell(f"【{step['title']}】\n\n{step['text']}", normal_font, text_alignment, thin_border),
+        ])
+        current_row += 1
+
+    executor.shutdown()
+    with perf_stage("excel_save", count=len(steps)) as rec:
+        wb.save(output)
+        if hasattr(output, "tell"): rec["bytes"] = output.tell()
+        elif isinstance(output, str): rec["bytes"] = os.path.getsize(output)
+
+def compute_export_key(steps, m_num, m_author, m_date, video_path, **image_options):
+    payload = {
+        "meta": [m_num, m_author, m_date.isoformat()],
+        "video": get_video_identity(video_path) if video_path else None,
+        "image": image_options,
+        "steps": [
+            {
+                "title": step.get('title'),
+                "text": step.get('text'),
+                "timestamp": clean_timestamp(step.get('timestamp', 0)),
+                "drawing": step.get('drawing_state'),
+            }
+            for step in steps
+        ],
+    }
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def export_excel_to_disk(export_key, steps, m_num, m_author, m_date, video_path, **image_options):
+    # 内容ハッシュをファイル名にしてディスクへ書き出し、同じ内容なら作成済みのファイルを返す
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = os.path.join(EXPORT_DIR, f"{export_key}.xlsx")
+    if os.path.exists(path):
+        os.utime(path)
+        return path
+    with atomic_output(path) as f:
+        write_excel_file(f, steps, m_num, m_author, m_date, video_path, **image_options)
+    prune_exports()
+    return path
+
+def prune_exports(max_files=EXPORT_MAX_FILES):
+    paths = sorted(glob.glob(os.path.join(EXPORT_DIR, "*.xlsx")), key=os.path.getmtime, reverse=True)
+    for stale in paths[max_files:]:
+        try:
+            os.remove(stale)
+        except OSError:
+            pass
+
+
+# --- 8. Gemini API処理 ---
+MANUAL_PROMPT = """
+あなたは製造現場の熟練管理者です。添付の動画を見て、新人作業員のための「標準作業手順書」を作成してください。
+以下のJSON形式で出力してください:
+[
+    {"title": "手順の見出し", "text": "具体的な作業内容。", "timestamp": 5.5},...
+]
+注意点: 
+- timestampは必ず「秒数（数値）」だけにしてください。（例: 5.5）
+"""
+UPLOAD_INDEX_PATH = os.path.join(VIDEO_STORE_DIR, "gemini_uploads.json")
+ANALYSIS_CACHE_DIR = os.path.join(VIDEO_STORE_DIR, "analysis")
+UPLOAD_REUSE_MARGIN = 3600  # 期限切れ1時間前のアップロードは再利用しない
+UPLOAD_DEFAULT_TTL = 47 * 3600  # Gemini側のファイル保持期間(48時間)より少し短め
+POLL_INITIAL_INTERVAL = 1.0
+POLL_MAX_INTERVAL = 10.0
+GENERATE_MAX_RETRIES = 3  # 429/5xxのとき同じモデルで再試行する回数
+GENERATE_BACKOFF_INITIAL = 2.0
+GENERATE_BACKOFF_MAX = 30.0
+MODEL_FALLBACK_LIMIT = 3  # 選んだモデルが使えないときに順に試す代わりのモデル数
+JSON_RETRY_PROMPT = """
+前回の出力はJSONとして読み取れませんでした。説明文やコードブロックを付けず、上記の形式のJSON配列だけを出力してください。
+"""
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hash_stream(f)
+
+def api_key_fingerprint(api_key):
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+class GeminiClient:
+    # APIキーごとの接続。genai.configure はプロセス全体の設定を書き換えるので使わず、
+    # キーごとに専用のクライアント一式を持つ（別のキーの解析と同時に動いても混ざらない）。
+    # メソッド名は genai の同名の関数に合わせている
+    def __init__(self, api_key):
+        self._clients = genai_client._ClientManager()
+        self._clients.configure(api_key=api_key)
+
+    def upload_file(self, path):
+        mime_type, _ = mimetypes.guess_type(path)
+        response = self._clients.get_default_client("file").create_file(
+            path=path, mime_type=mime_type, name=None, display_name=os.path.basename(path), resumable=True)
+        return file_types.File(response)
+
+    def get_file(self, name):
+        return file_types.File(self._clients.get_default_client("file").get_file(name=name))
+
+    def list_files(self, page_size=100):
+        for proto in self._clients.get_default_client("file").list_files(genai.protos.ListFilesRequest(page_size=page_size)):
+            yield file_types.File(proto)
+
+    def delete_file(self, name):
+        self._clients.get_default_client("file").delete_file(request=genai.protos.DeleteFileRequest(name=name))
+
+    def list_models(self):
+        return genai.list_models(client=self._clients.get_default_client("model"))
+
+    def GenerativeModel(self, model_name):
+        model = genai.GenerativeModel(model_name=model_name)
+        model._client = self._clients.get_default_client("generative")
+        return model
+
+@cached_resource(max_entries=16)
+def get_gemini_client(api_key):
+    return GeminiClient(api_key)
+
+def write_json_atomic(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with atomic_output(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+
+class UploadIndex:
+    # (APIキー, 動画ハッシュ) -> Gemini側のファイル名と有効期限
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, api_key, video_digest):
+        with self._lock:
+            entry = self.entries.get(f"{api_key_fingerprint(api_key)}:{video_digest}")
+        if entry and entry["expires_at"] - time.time() > UPLOAD_REUSE_MARGIN:
+            return entry
+        return None
+
+    def put(self, api_key, video_digest, name, expires_at):
+        now = time.time()
+        with self._lock:
+            self.entries = {k: v for k, v in self.entries.items() if v["expires_at"] > now}
+            self.entries[f"{api_key_fingerprint(api_key)}:{video_digest}"] = {"name": name, "expires_at": expires_at}
+            write_json_atomic(self.path, self.entries)
+
+    def remove(self, api_key, video_digest):
+        with self._lock:
+            if self.entries.pop(f"{api_key_fingerprint(api_key)}:{video_digest}", None) is not None:
+                write_json_atomic(self.path, self.entries)
+
+    def names_for(self, api_key):
+        prefix = f"{api_key_fingerprint(api_key)}:"
+        with self._lock:
+            return {entry["name"] for key, entry in self.entries.items() if key.startswith(prefix)}
+
+    def forget_names(self, api_key, names):
+        # Gemini側で削除したファイルを指す記録を消し、次回は再アップロードさせる
+        prefix = f"{api_key_fingerprint(api_key)}:"
+        names = set(names)
+        with self._lock:
+            stale = [key for key, entry in self.entries.items() if key.startswith(prefix) and entry["name"] in names]
+            for key in stale:
+                del self.entries[key]
+            if stale: write_json_atomic(self.path, self.entries)
+
+class AnalysisCache:
+    # (動画ハッシュ, モデル, プロンプト) -> 生成された手順JSON
+    def __init__(self, root):
+        self.root = root
+
+    def key_for(self, video_digest, model_name, prompt):
+        raw = json.dumps([video_digest, model_name, prompt], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.root, f"{key}.json"), encoding="utf-8") as f:
+                return json.load(f) or None
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, steps):
+        # 空の結果を保存すると、以後は解析し直さずに空のまま返してしまう
+        if not steps: return
+        write_json_atomic(os.path.join(self.root, f"{key}.json"), steps)
+
+@cached_resource()
+def get_upload_index():
+    return UploadIndex(UPLOAD_INDEX_PATH)
+
+@cached_resource()
+def get_analysis_cache():
+    return AnalysisCache(ANALYSIS_CACHE_DIR)
+
+def api_error_code(e):
+    # google.api_core の例外はHTTPステータスを code に持つ。無ければメッセージから拾う
+    code = getattr(e, "code", None)
+    if isinstance(code, int): return code
+    match = re.search(r"\b(400|404|429|5\d\d)\b", str(e))
+    return int(match.group(1)) if match else None
+
+def get_or_upload_video(video_path, api_key, video_digest, on_progress, upload_index):
+    client = get_gemini_client(api_key)
+    video_file = None
+    entry = upload_index.get(api_key, video_digest)
+    if entry:
+        try:
+            video_file = client.get_file(entry["name"])
+            if video_file.state.name == "FAILED": video_file = None
+        except Exception:
+            video_file = None
+        if video_file is None: upload_index.remove(api_key, video_digest)
+
+    if video_file is None:
+        on_progress(10, "📤 動画をAIサーバーにアップロード中...")
+        with perf_stage("upload", bytes=os.path.getsize(video_path)):
+            video_file = client.upload_file(video_path)
+        expiration = getattr(video_file, "expiration_time", None)
+        expires_at = expiration.timestamp() if expiration else time.time() + UPLOAD_DEFAULT_TTL
+        upload_index.put(api_key, video_digest, video_file.name, expires_at)
+    else:
+        on_progress(10, "♻️ アップロード済みの動画を再利用します...")
+
+    interval = POLL_INITIAL_INTERVAL
+    with perf_stage("processing_poll", count=0) as rec:
+        while video_file.state.name == "PROCESSING":
+            on_progress(30, "⏳ AI側で動画を処理しています...（数秒〜数分）")
+            time.sleep(interval)
+            interval = min(interval * 2, POLL_MAX_INTERVAL)
+            video_file = client.get_file(video_file.name)
+            rec["count"] += 1
+
+    if video_file.state.name == "FAILED":
+        upload_index.remove(api_key, video_digest)
+        raise ValueError("動画の処理に失敗しました。")
+    return video_file
+
+def process_video_with_gemini(video_path, api_key, selected_model, video_digest=None, use_cache=True,
+                              on_progress=None, upload_index=None, analysis_cache=None, use_proxy=False, on_step=None,
+                              fallback_models=(), on_restart=None, on_fallback=None):
+    # UIに触れないので、ジョブのワーカースレッドからそのまま呼べる
+    # fallback_models: selected_model で生成できないときに順に試すモデル（優先順）
+    # on_restart: 生成をやり直す直前に呼ぶ（途中経過の手順を捨てる用）、on_fallback: 代わりのモデルで生成できたときにそのモデル名で呼ぶ
+    on_progress = on_progress or (lambda percent, text: None)
+    video_digest = video_digest or file_digest(video_path)
+    upload_index = upload_index or get_upload_index()
+    analysis_cache = analysis_cache or get_analysis_cache()
+    models = [selected_model] + [m for m in dict.fromkeys(fallback_models) if m != selected_model][:MODEL_FALLBACK_LIMIT]
+    if use_proxy:
+        return analyze_with_proxy(video_path, api_key, models, video_digest, use_cache, on_progress, upload_index, analysis_cache, on_step, on_restart, on_fallback)
+    return analyze_single_video(video_path, api_key, models, video_digest, use_cache, on_progress, upload_index, analysis_cache, on_step, on_restart, on_fallback)
+
+class MalformedResponseError(ValueError):
+    pass
+
+def normalize_steps(data):
+    # 画面とExcel出力が前提とする形（titleとtextは文字列、timestampは0以上の秒数）にそろえる
+    if isinstance(data, dict): data = data.get("steps", data.get("manual"))
+    if not isinstance(data, list): raise MalformedResponseError("手順のJSON配列ではありません。")
+    steps = []
+    for item in data:
+        if not isinstance(item, dict): continue
+        title = str(item.get("title") or "").strip()
+        text = str(item.get("text") or "").strip()
+        if not (title or text): continue
+        steps.append({"title": title or text[:20], "text": text, "timestamp": max(0.0, clean_timestamp(item.get("timestamp")))})
+    if not steps: raise MalformedResponseError("手順が1つも含まれていませんでした。")
+    return steps
+
+def strip_trailing_commas(body):
+    # 文字列の外にある「, ]」「, }」のカンマだけを消す（文字列の中身は書き換えない）
+    out = []
+    in_string = escape = False
+    pending_comma = None
+    for ch in body:
+        if in_string:
+            if escape: escape = False
+            elif ch == "\\": escape = True
+            elif ch == '"': in_string = False
+            out.append(ch)
+            continue
+        if pending_comma is not None:
+            if ch.isspace():
+                pending_comma += ch
+                continue
+            if ch in "]}": pending_comma = pending_comma[1:]
+            out.append(pending_comma)
+            pending_comma = None
+        if ch == ",":
+            pending_comma = ","
+            continue
+        if ch == '"': in_string = True
+        out.append(ch)
+    if pending_comma is not None: out.append(pending_comma)
+    return "".join(out)
+
+def repair_steps_json(text):
+    # まずそのまま読み、読めなければよくある崩れ（コードブロック・前後の説明文・末尾のカンマ）を直して読む。
+    # それでも配列として読めなければ、元の文字列から閉じている手順オブジェクトだけを拾う
+    try:
+        return normalize_steps(json.loads(text))
+    except ValueError:
+        pass
+    fenced = re.search(r"```(?:json)?\s*(.*?)```", text, re.S)
+    body = fenced.group(1) if fenced else text
+    start, end = body.find("["), body.rfind("]")
+    if start != -1 and end > start: body = body[start:end + 1]
+    try:
+        data = json.loads(strip_trailing_commas(body))
+    except ValueError:
+        data = StepStreamParser().feed(text)
+    return normalize_steps(data)
+
+class StepStreamParser:
+    # ストリーミングで届くJSON配列から、閉じた手順オブジェクトを順に取り出す
+    def __init__(self):
+        self.text = ""
+        self.pos = 0
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.object_start = None
+
+    def feed(self, chunk):
+        self.text += chunk
+        steps = []
+        for i in range(self.pos, len(self.text)):
+            ch = self.text[i]
+            if self.in_string:
+                if self.escape: self.escape = False
+                elif ch == "\\": self.escape = True
+                elif ch == '"': self.in_string = False
+                continue
+            if ch == '"':
+                self.in_string = True
+            elif ch in "[{":
+                if ch == "{" and self.stack == ["["]: self.object_start = i
+                self.stack.append(ch)
+            elif ch in "]}":
+                if self.stack: self.stack.pop()
+                if ch == "}" and self.stack == ["["] and self.object_start is not None:
+                    try:
+                        step = json.loads(self.text[self.object_start:i + 1])
+                    except ValueError:
+                        step = None
+                    if isinstance(step, dict): steps.append(step)
+                    self.object_start = None
+        self.pos = len(self.text)
+        return steps
+
+SAFETY_SETTINGS = [
+    {"category": HarmCategory.HARM_CATEGORY_HARASSMENT, "threshold": HarmBlockThreshold.BLOCK_NONE},
+    {"category": HarmCategory.HARM_CATEGORY_HATE_SPEECH, "threshold": HarmBlockThreshold.BLOCK_NONE},
+    {"category": HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT, "threshold": HarmBlockThreshold.BLOCK_NONE},
+    {"category": HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT, "threshold": HarmBlockThreshold.BLOCK_NONE},
+]
+
+def generate_steps(client, video_file, model_name, prompt, on_progress, on_step):
+    on_progress(60, f"🤖 マニュアルを生成中...（モデル: {model_name}）")
+    model = client.GenerativeModel(model_name)
+    with perf_stage("generate_content", model=model_name) as rec:
+        started = time.perf_counter()
+        response = model.generate_content(
+            [video_file, prompt],
+            generation_config={"response_mime_type": "application/json"},
+            safety_settings=SAFETY_SETTINGS,
+            stream=True,
+        )
+        # 届いた順に手順を取り出して画面へ渡す（全文がそろうのを待たない）
+        parser = StepStreamParser()
+        streamed_steps = []
+        for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:
+                continue  # テキストを含まないチャンク（終了理由のみ等）
+            # 最初のチャンクまでの時間で、モデルの待ち時間と生成速度を分けて見られるようにする
+            rec.setdefault("first_chunk_s", round(time.perf_counter() - started, 4))
+            for step in parser.feed(text):
+                streamed_steps.append(step)
+                on_step(step)
+                on_progress(60, f"🤖 マニュアルを生成中...（{len(streamed_steps)}手順まで生成, モデル: {model_name}）")
+        rec["bytes"] = len(parser.text.encode("utf-8"))
+        rec["count"] = len(streamed_steps)
+    try:
+        return repair_steps_json(parser.text)
+    except MalformedResponseError:
+        if not streamed_steps: raise
+        return normalize_steps(streamed_steps)
+
+def generate_with_fallback(client, video_file, models, on_progress, on_step, on_restart):
+    # アップロード済みのファイルはそのまま使い回し、生成だけをやり直す
+    # 429/5xx: 指数バックオフで再試行 → 尽きたら次のモデル / 400・404（モデル非対応など）: すぐ次のモデル
+    # JSONが崩れていた: 形式を念押しして1回だけ再生成 → それでも駄目なら次のモデル
+    last_error = None
+    started = False
+    for model_index, model_name in enumerate(models):
+        prompt = MANUAL_PROMPT
+        delay = GENERATE_BACKOFF_INITIAL
+        attempt = 0
+        while True:
+            if started: on_restart()
+            started = True
+            try:
+                return model_name, generate_steps(client, video_file, model_name, prompt, on_progress, on_step)
+            except MalformedResponseError as e:
+                last_error = e
+                if prompt != MANUAL_PROMPT: break
+                prompt = MANUAL_PROMPT + JSON_RETRY_PROMPT
+                on_progress(60, f"🩹 出力を読み取れなかったため、形式を指定して再生成します...（モデル: {model_name}）")
+            except Exception as e:
+                last_error = e
+                code = api_error_code(e)
+                if code in (400, 404): break
+                if not (code == 429 or (code or 0) >= 500): raise
+                if attempt >= GENERATE_MAX_RETRIES: break
+                attempt += 1
+                wait = delay * (0.5 + random.random())
+                on_progress(60, f"⏳ {model_name} が混雑しています。{wait:.0f}秒後に再試行します...（{attempt}/{GENERATE_MAX_RETRIES}）")
+                time.sleep(wait)
+                delay = min(delay * 2, GENERATE_BACKOFF_MAX)
+        if model_index + 1 < len(models):
+            on_progress(60, f"🔀 {model_name} で生成できなかったため、{models[model_index + 1]} に切り替えます...")
+    raise last_error
+
+def analyze_single_video(video_path, api_key, models, video_digest, use_cache, on_progress, upload_index, analysis_cache,
+                         on_step=None, on_restart=None, on_fallback=None):
+    # models: 先頭が選択されたモデル、以降は生成できなかったときに順に試すモデル
+    on_step = on_step or (lambda step: None)
+    on_restart = on_restart or (lambda: None)
+    if use_cache:
+        cached_steps = analysis_cache.get(analysis_cache.key_for(video_digest, models[0], MANUAL_PROMPT))
+        if cached_steps is not None:
+            return cached_steps
+
+    video_file = get_or_upload_video(video_path, api_key, video_digest, on_progress, upload_index)
+    model_name, steps = generate_with_fallback(get_gemini_client(api_key), video_file, models, on_progress, on_step, on_restart)
+    # キャッシュは実際に生成したモデルの名前で保存する
+    analysis_cache.put(analysis_cache.key_for(video_digest, model_name, MANUAL_PROMPT), steps)
+    if model_name != models[0] and on_fallback: on_fallback(model_name)
+    on_progress(100, "完了！")
+    return steps
+
+# --- 9. プロキシ動画 & 区間分割解析 ---
+PROXY_MAX_HEIGHT = 360
+PROXY_FPS = 2.0
+SEGMENT_SECONDS = 600  # これより長い動画は区間に分けて並列に解析する
+SEGMENT_OVERLAP = 30  # 区間の境目で手順が切れないよう前後に重ねる秒数
+SEGMENT_WORKERS = 3
+DEDUPE_SECONDS = 3.0
+
+def plan_segments(duration, segment_seconds=SEGMENT_SECONDS, overlap=SEGMENT_OVERLAP):
+    if duration <= segment_seconds: return [(0.0, duration)]
+    segments = []
+    start = 0.0
+    while True:
+        end = min(start + segment_seconds, duration)
+        segments.append((start, end))
+        if end >= duration: break
+        start = end - overlap
+    return segments
+
+def build_proxy_segments(video_path, segments, out_paths, max_height=PROXY_MAX_HEIGHT, fps=PROXY_FPS):
+    # 元動画を1回だけ先頭から読み、低解像度・低fpsのフレームを各区間のファイルへ振り分ける
+    cap = cv2.VideoCapture(video_path)
+    src_fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    cap.release()
+    # 元動画のfpsが低い（タイムラプス等）と書き出しのfpsの方が速くなり、再生時間が縮んで秒数がずれる。
+    # 書き出しは元動画より速くせず、各フレームは区間の先頭からの秒数に当たる枠へ置き、間の枠は直前のフレームで埋める
+    out_fps = min(fps, src_fps)
+    fourcc = cv2.VideoWriter_fourcc(*"mp4v")
+    part_paths = [f"{path}.part.mp4" for path in out_paths]
+    writers = [None] * len(segments)
+    written = [0] * len(segments)
+    previous = [None] * len(segments)
+    os.makedirs(os.path.dirname(out_paths[0]), exist_ok=True)
+    size = None
+    try:
+        for t, frame in iter_sampled_frames(video_path, out_fps):
+            if size is None:
+                height, width = frame.shape[:2]
+                scale = min(1.0, max_height / height)
+                size = (max(2, int(width * scale) // 2 * 2), max(2, int(height * scale) // 2 * 2))
+            small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            for i, (start, end) in enumerate(segments):
+                if start <= t <= end:
+                    if writers[i] is None:
+                        writers[i] = cv2.VideoWriter(part_paths[i], fourcc, out_fps, size)
+                    slot = int(round((t - start) * out_fps))
+                    if slot < written[i]: continue
+                    while written[i] < slot:
+                        writers[i].write(small if previous[i] is None else previous[i])
+                        written[i] += 1
+                    writers[i].write(small)
+                    written[i] += 1
+                    previous[i] = small
+    finally:
+        for writer in writers:
+            if writer is not None: writer.release()
+    for part_path, path in zip(part_paths, out_paths):
+        if os.path.exists(part_path): os.replace(part_path, path)
+
+def to_global_step(segments, index, step, overlap=SEGMENT_OVERLAP):
+    # 区間内の秒数を全体の秒数に直す。重なり部分は区間の中点で担当を分け、担当外ならNone
+    start, end = segments[index]
+    owned_from = start + overlap / 2 if index > 0 else float("-inf")
+    owned_to = end - overlap / 2 if index < len(segments) - 1 else float("inf")
+    ts = start + clean_timestamp(step.get('timestamp', 0))
+    if owned_from <= ts < owned_to:
+        return {**step, 'timestamp': round(ts, 1)}
+    return None
+
+def merge_segment_steps(segments, segment_steps, overlap=SEGMENT_OVERLAP):
+    merged = []
+    for i, steps in enumerate(segment_steps):
+        for step in steps or []:
+            if not isinstance(step, dict): continue
+            global_step = to_global_step(segments, i, step, overlap)
+            if global_step is not None: merged.append(global_step)
+    merged.sort(key=lambda step: step['timestamp'])
+    deduped = []
+    for step in merged:
+        prev = deduped[-1] if deduped else None
+        if prev and step['timestamp'] - prev['timestamp'] < DEDUPE_SECONDS and step.get('title') == prev.get('title'):
+            continue
+        deduped.append(step)
+    return deduped
+
+def analyze_with_proxy(video_path, api_key, models, video_digest, use_cache, on_progress, upload_index, analysis_cache, on_step=None, on_restart=None, on_fallback=None):
+    on_step = on_step or (lambda step: None)
+    on_restart = on_restart or (lambda: None)
+    selected_model = models[0]
+    proxy_tag = f"proxy{PROXY_MAX_HEIGHT}p{PROXY_FPS:g}fps_cfr"  # 秒数を元動画に合わせた書き出し方式。以前のプロキシと解析結果は使わない
+    cache_key = analysis_cache.key_for(f"{video_digest}:{proxy_tag}:{SEGMENT_SECONDS}s:{SEGMENT_OVERLAP}s", selected_model, MANUAL_PROMPT)
+    if use_cache:
+        cached_steps = analysis_cache.get(cache_key)
+        if cached_steps is not None:
+            return cached_steps
+
+    cap = cv2.VideoCapture(video_path)
+    duration = cap.get(cv2.CAP_PROP_FRAME_COUNT) / (cap.get(cv2.CAP_PROP_FPS) or 30.0)
+    cap.release()
+    segments = plan_segments(duration)
+    count = len(segments)
+    proxy_paths = [os.path.join(PROXY_DIR, f"{video_digest}_{proxy_tag}_{i + 1}of{count}.mp4") for i in range(count)]
+    if not all(os.path.exists(path) for path in proxy_paths):
+        on_progress(5, f"🎞️ 軽量プロキシ動画を作成中...（{count}区間）")
+        with perf_stage("proxy_build", count=count):
+            build_proxy_segments(video_path, segments, proxy_paths)
+    # 作れなかった区間があると手順が抜けた結果になるので、解析を始める前に止める
+    missing = [i + 1 for i, path in enumerate(proxy_paths) if not os.path.exists(path)]
+    if missing: raise ValueError(f"プロキシ動画を作成できなかった区間があります（{', '.join(map(str, missing))} / {count}区間）。")
+
+    # 途中経過は区間ごとに持ち、区間がやり直しになったらその区間の分だけ消して残りを流し直す
+    partial_lock = threading.Lock()
+    segment_partials = [[] for _ in segments]
+
+    def segment_step_callback(index):
+        def forward(step):
+            global_step = to_global_step(segments, index, step)
+            if global_step is None: return
+            with partial_lock:
+                segment_partials[index].append(global_step)
+                on_step(global_step)
+        return forward
+
+    def segment_restart_callback(index):
+        def restart():
+            with partial_lock:
+                if not segment_partials[index]: return
+                segment_partials[index] = []
+                on_restart()
+                for partial in segment_partials:
+                    for step in partial: on_step(step)
+        return restart
+
+    # 区間ごとに代わりのモデルへ切り替わることがあるので、使われたモデルを集めておく
+    fallback_used = set()
+    segment_steps = [[] for _ in segments]
+    on_progress(20, f"🤖 区間ごとに解析中...（0/{count} 完了, モデル: {selected_model}）")
+    with ThreadPoolExecutor(max_workers=SEGMENT_WORKERS) as executor:
+        futures = {
+            submit_in_context(
+                executor, analyze_single_video, proxy_paths[i], api_key, models, f"{video_digest}:{proxy_tag}:{i + 1}of{count}",
+                use_cache, lambda percent, text: None, upload_index, analysis_cache, segment_step_callback(i),
+                segment_restart_callback(i), fallback_used.add,
+            ): i
+            for i in range(count)
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            segment_steps[futures[future]] = future.result()
+            on_progress(20 + 75 * done // count, f"🤖 区間ごとに解析中...（{done}/{count} 完了, モデル: {selected_model}）")
+
+    steps = merge_segment_steps(segments, segment_steps)
+    # 選んだモデルだけで作れた結果のみ全体のキャッシュに入れる（区間ごとの結果は各モデル名で保存済み）
+    if fallback_used:
+        if on_fallback: on_fallback(", ".join(sorted(fallback_used)))
+    elif steps:
+        analysis_cache.put(cache_key, steps)
+    on_progress(100, "完了！")
+    return steps
+
+# --- 10. 解析ジョブ（バックグラウンド実行） ---
+ANALYSIS_WORKERS = int(os.environ.get("NANO_FACTORY_ANALYSIS_WORKERS", "4"))
+JOB_RETENTION = 6 * 3600  # 終了したジョブを保持する秒数
+
+class AnalysisJob:
+    def __init__(self, video_digest, model_name, key_fingerprint, options):
+        self.job_id = uuid.uuid4().hex
+        self.video_digest = video_digest
+        self.model_name = model_name
+        self.key_fingerprint = key_fingerprint  # 依頼したAPIキー。別のキーのセッションには見せない
+        self.options = options  # (use_cache, use_proxy, fallback_models)。同じ条件の依頼だけを相乗りさせる
+        self.status = "queued"  # queued / running / done / failed
+        self.progress = 0
+        self.message = "⏳ 順番待ち中..."
+        self.result = None
+        self.partial_steps = []  # 生成途中に届いた手順（画面の途中経過表示用）
+        self.error = None
+        self.notice = None  # 代わりのモデルで生成したときの知らせ
+        self.finished_at = None
+
+    @property
+    def active(self):
+        return self.status in ("queued", "running")
+
+    def update(self, progress, message):
+        self.progress = progress
+        self.message = message
+
+class AnalysisJobManager:
+    # プロセス全体で共有。同時に走る解析はワーカー数で上限を設ける
+    def __init__(self, upload_index, analysis_cache, max_workers=ANALYSIS_WORKERS):
+        self.upload_index = upload_index
+        self.analysis_cache = analysis_cache
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="analysis")
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, video_path, api_key, model_name, video_digest, use_cache=True, use_proxy=False, fallback_models=()):
+        key_fingerprint = api_key_fingerprint(api_key)
+        options = (use_cache, use_proxy, tuple(fallback_models))
+        with self._lock:
+            self._prune()
+            job = self._find_active(video_digest, key_fingerprint, model_name, options)
+            if job is not None:
+                return job
+            job = AnalysisJob(video_digest, model_name, key_fingerprint, options)
+            self.jobs[job.job_id] = job
+        # 計測の記録先は依頼したセッションのものをジョブのスレッドへ引き継ぐ
+        submit_in_context(self.executor, self._run, job, video_path, api_key, use_cache, use_proxy, fallback_models)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def find_active(self, video_digest, api_key, model_name=None):
+        # 再接続は同じAPIキーで依頼されたジョブに限る（同じ動画を上げた別のユーザーのジョブには繋がない）
+        with self._lock:
+            return self._find_active(video_digest, api_key_fingerprint(api_key), model_name)
+
+    def _find_active(self, video_digest, key_fingerprint, model_name, options=None):
+        for job in self.jobs.values():
+            if not (job.active and job.video_digest == video_digest and job.key_fingerprint == key_fingerprint): continue
+            if model_name in (None, job.model_name) and options in (None, job.options):
+                return job
+        return None
+
+    def _prune(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished_at and now - job.finished_at > JOB_RETENTION:
+                del self.jobs[job_id]
+
+    def _run(self, job, video_path, api_key, use_cache, use_proxy, fallback_models):
+        job.status = "running"
+        job.update(5, "準備中...")
+        try:
+            with perf_stage("analysis_job", model=job.model_name, proxy=use_proxy):
+                job.result = process_video_with_gemini(
+                    video_path, api_key, job.model_name, job.video_digest, use_cache,
+                    on_progress=job.update, upload_index=self.upload_index, analysis_cache=self.analysis_cache,
+                    use_proxy=use_proxy, on_step=job.partial_steps.append, fallback_models=fallback_models,
+                    on_restart=job.partial_steps.clear, on_fallback=lambda model: setattr(job, "notice", f"ℹ️ '{job.model_name}' で生成できなかったため、'{model}' で作成しました。"),
+                )
+            job.status = "done"
+        except Exception as e:
+            if "429" in str(e):
+                job.error = f"⚠️ API制限エラー: '{job.model_name}' は利用不可または制限超過です。しばらく待つか、別のモデルを選んでください。"
+            else:
+                job.error = f"エラーが発生しました: {e}"
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+
+@cached_resource()
+def get_job_manager():
+    return AnalysisJobManager(get_upload_index(), get_analysis_cache())
+
+
+# --- 11. ナレーション音声（TTSエンジン差し替え可 & ディスクキャッシュ） ---
+NARRATION_DIR = os.path.join(VIDEO_STORE_DIR, "narration")
+NARRATION_MAX_BYTES = 256 * 1024 ** 2
+NARRATION_WORKERS = 4
+NARRATION_LANG = "ja"
+TTS_BACKEND = os.environ.get("NANO_FACTORY_TTS_BACKEND", "gtts")
+
+class GTTSBackend:
+    name = "gtts"
+    extension = "mp3"
+    mime = "audio/mp3"
+
+    def synthesize(self, text, lang, fp):
+        from gtts import gTTS
+        gTTS(text=text, lang=lang).write_to_fp(fp)
+
+class ToneBackend:
+    # ネットワーク不要の代替エンジン。文字数に応じた長さの短い音をWAVで書き出す（テスト・オフライン用）
+    name = "tone"
+    extension = "wav"
+    mime = "audio/wav"
+    sample_rate = 16000
+    seconds_per_char = 0.08
+
+    def synthesize(self, text, lang, fp):
+        n = int(self.sample_rate * min(max(len(text) * self.seconds_per_char, 0.3), 30))
+        t = np.arange(n) / self.sample_rate
+        samples = (0.2 * 32767 * np.sin(2 * np.pi * 440 * t) * np.exp(-3 * (t % 0.5))).astype("<i2")
+        with wave.open(fp, "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(self.sample_rate)
+            w.writeframes(samples.tobytes())
+
+TTS_BACKENDS = {backend.name: backend for backend in (GTTSBackend, ToneBackend)}
+
+class NarrationCache:
+    # 本文とエンジン・言語のハッシュをファイル名にして音声を保存する。再起動後や別プロセスからも再利用できる
+    def __init__(self, backend, base_dir=NARRATION_DIR, max_bytes=NARRATION_MAX_BYTES, max_workers=NARRATION_WORKERS):
+        self.backend = backend
+        self.base_dir = base_dir
+        self.max_bytes = max_bytes
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        os.makedirs(base_dir, exist_ok=True)
+
+    def path_for(self, text, lang=NARRATION_LANG):
+        raw = json.dumps([self.backend.name, lang, text], ensure_ascii=False)
+        key = hashlib.sha256(raw.encode("utf-8")).hexdigest()
+        return os.path.join(self.base_dir, f"{key}.{self.backend.extension}")
+
+    def lookup(self, text, lang=NARRATION_LANG):
+        if not text: return None
+        path = self.path_for(text, lang)
+        return path if os.path.exists(path) else None
+
+    def synthesize(self, text, lang=NARRATION_LANG):
+        if not text: return None
+        path = self.path_for(text, lang)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(path, threading.Lock())
+        # 同じ本文の合成が同時に来ても、エンジンを呼ぶのは1回だけにする
+        with key_lock:
+            if os.path.exists(path):
+                os.utime(path)
+                return path
+            try:
+                with atomic_output(path) as f, perf_stage("tts", backend=self.backend.name) as rec:
+                    self.backend.synthesize(text, lang, f)
+                    rec["bytes"] = f.tell()
+            finally:
+                with self._lock:
+                    self._key_locks.pop(path, None)
+        return path
+
+    def synthesize_all(self, texts, lang=NARRATION_LANG, on_progress=None):
+        # 全手順をまとめて並列に合成する。キャッシュ済みの本文はエンジンを呼ばずにすぐ返る
+        results = [None] * len(texts)
+        errors = []
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="narration") as executor:
+            futures = {submit_in_context(executor, self.synthesize, text, lang): i for i, text in enumerate(texts) if text}
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    errors.append(f"手順{futures[future] + 1}: {e}")
+                if on_progress: on_progress(done, len(futures))
+        self.evict(keep=set(results))
+        return results, errors
+
+    def evict(self, keep=()):
+        entries = []
+        for name in os.listdir(self.base_dir):
+            path = os.path.join(self.base_dir, name)
+            if name.endswith(".part") or path in keep: continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes: break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+@cached_resource()
+def get_narration_cache(backend_name=TTS_BACKEND):
+    return NarrationCache(TTS_BACKENDS[backend_name]())
+
+
+# --- 12. Gemini側ファイルの一括削除 ---
+CLEANUP_WORKERS = 8
+CLEANUP_MAX_RETRIES = 5
+CLEANUP_BACKOFF_INITIAL = 1.0
+CLEANUP_BACKOFF_MAX = 30.0
+
+class RateLimitGate:
+    # どれか1つのワーカーが429を受けたら、全ワーカーの次の呼び出しをその分だけ遅らせる
+    def __init__(self):
+        self.resume_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            delay = self.resume_at - time.time()
+        if delay > 0: time.sleep(delay)
+
+    def pause(self, seconds):
+        with self._lock:
+            self.resume_at = max(self.resume_at, time.time() + seconds)
+
+class CleanupReport:
+    def __init__(self, listed, targets):
+        self.listed = listed
+        self.targets = targets
+        self.deleted = []
+        self.failed = []  # (ファイル名, エラー内容)
+
+    @property
+    def skipped(self):
+        return self.listed - len(self.targets)
+
+def delete_remote_file(client, name, gate, max_retries=CLEANUP_MAX_RETRIES):
+    # 429/5xxは指数バックオフ(ゆらぎ付き)で再試行し、404は削除済みとして成功扱いにする
+    delay = CLEANUP_BACKOFF_INITIAL
+    for attempt in range(max_retries + 1):
+        gate.wait()
+        try:
+            client.delete_file(name)
+            return
+        except Exception as e:
+            code = api_error_code(e)
+            if code == 404: return
+            if attempt == max_retries or not (code == 429 or (code or 0) >= 500): raise
+            wait = delay * (0.5 + random.random())
+            if code == 429: gate.pause(wait)
+            else: time.sleep(wait)
+            delay = min(delay * 2, CLEANUP_BACKOFF_MAX)
+
+def select_cleanup_targets(files, older_than_hours=None, keep_names=()):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    targets = []
+    for f in files:
+        if f.name in keep_names: continue
+        if older_than_hours:
+            created = getattr(f, "create_time", None)
+            if created is None or now - created < datetime.timedelta(hours=older_than_hours): continue
+        targets.append(f.name)
+    return targets
+
+def clear_remote_files(api_key, older_than_hours=None, only_unreferenced=False, upload_index=None,
+                       max_workers=CLEANUP_WORKERS, on_progress=None):
+    # only_unreferenced: このサーバーのアップロード記録に載っている（再利用予定の）ファイルは残す
+    upload_index = upload_index or get_upload_index()
+    client = get_gemini_client(api_key)
+    with perf_stage("storage_list") as rec:
+        files = list(client.list_files())
+        rec["count"] = len(files)
+    keep_names = upload_index.names_for(api_key) if only_unreferenced else ()
+    report = CleanupReport(len(files), select_cleanup_targets(files, older_than_hours, keep_names))
+    if not report.targets: return report
+
+    gate = RateLimitGate()
+    with perf_stage("storage_cleanup", count=len(report.targets)), \
+            ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cleanup") as executor:
+        futures = {submit_in_context(executor, delete_remote_file, client, name, gate): name for name in report.targets}
+        for done, future in enumerate(as_completed(futures), 1):
+            name = futures[future]
+            try:
+                future.result()
+                report.deleted.append(name)
+            except Exception as e:
+                report.failed.append((name, str(e)))
+            if on_progress: on_progress(done, len(futures))
+    upload_index.forget_names(api_key, report.deleted)
+    return report
@@ -0,0 +1,172 @@
+# 動画フォルダをまとめて解析し、動画ごとに標準作業手順書(.xlsx)を作るバッチ処理
+# 使い方: python sop_batch.py 動画フォルダ -o 出力フォルダ --model gemini-1.5-flash --author 管理者
+import os
+import sys
+import json
+import argparse
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from manual_core import (
+    EXCEL_IMAGE_FORMAT,
+    EXCEL_IMAGE_FORMATS,
+    EXCEL_IMAGE_MAX_SIZE,
+    EXCEL_IMAGE_QUALITY,
+    PerfRecorder,
+    atomic_output,
+    configure_perf_log,
+    file_digest,
+    perf_recording,
+    process_video_with_gemini,
+    submit_in_context,
+    write_excel_file,
+    write_json_atomic,
+)
+
+VIDEO_EXTENSIONS = (".mp4", ".mov")
+PROGRESS_FILENAME = "progress.json"
+
+class BatchProgress:
+    # 出力フォルダの progress.json に動画ごとの状態を記録し、中断後の再実行では完了済みを飛ばす
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def is_done(self, name, digest, output):
+        entry = self.entries.get(name) or {}
+        return entry.get("status") == "done" and entry.get("digest") == digest and entry.get("output") == output and os.path.exists(output)
+
+    def assign_indexes(self, names):
+        # 番号の{index}は初回に割り当てた値を使い続ける。後から増えた動画には続きの番号を振り、既存の番号をずらさない
+        with self._lock:
+            next_index = max((entry.get("index", 0) for entry in self.entries.values()), default=0) + 1
+            for name in names:
+                entry = self.entries.setdefault(name, {})
+                if not entry.get("index"):
+                    entry["index"] = next_index
+                    next_index += 1
+            write_json_atomic(self.path, self.entries)
+            return {name: self.entries[name]["index"] for name in names}
+
+    def record(self, name, **fields):
+        with self._lock:
+            self.entries[name] = {**self.entries.get(name, {}), **fields, "updated_at": datetime.datetime.now().isoformat(timespec="seconds")}
+            write_json_atomic(self.path, self.entries)
+
+def load_metadata(path):
+    # {"動画ファイル名": {"manual_number": ..., "author": ..., "date": "YYYY-MM-DD", "model": ...}} 形式
+    if not path: return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def build_jobs(args, progress):
+    metadata = load_metadata(args.metadata)
+    names = sorted(name for name in os.listdir(args.video_dir) if name.lower().endswith(VIDEO_EXTENSIONS))
+    indexes = progress.assign_indexes(names)
+    jobs = []
+    for name in names:
+        meta = metadata.get(name, {})
+        stem = os.path.splitext(name)[0]
+        manual_number = str(meta.get("manual_number") or args.number_format.format(stem=stem, index=indexes[name]))
+        jobs.append({
+            "name": name,
+            "path": os.path.join(args.video_dir, name),
+            "manual_number": manual_number,
+            "output": os.path.join(args.output_dir, f"{manual_number}.xlsx"),
+            "author": meta.get("author") or args.author,
+            "date": datetime.date.fromisoformat(meta["date"]) if meta.get("date") else args.date,
+            "model": meta.get("model") or args.model,
+        })
+    return jobs
+
+def find_output_conflicts(jobs):
+    # 同じ出力ファイルに書く動画の組を返す（大文字小文字を区別しないファイルシステムも考慮）
+    owners = {}
+    for job in jobs:
+        owners.setdefault(os.path.normcase(os.path.abspath(job["output"])), []).append(job["name"])
+    return [names for names in owners.values() if len(names) > 1]
+
+def process_job(job, args, api_key, progress):
+    digest = file_digest(job["path"])
+    if progress.is_done(job["name"], digest, job["output"]):
+        return "skipped", progress.entries[job["name"]]["output"]
+    progress.record(job["name"], status="running", digest=digest, model=job["model"], fallback_model=None)
+    steps = process_video_with_gemini(job["path"], api_key, job["model"], digest, use_cache=not args.no_cache, use_proxy=args.proxy,
+                                      fallback_models=args.fallback_model, on_fallback=lambda model: progress.record(job["name"], fallback_model=model))
+    if not steps:
+        raise ValueError("解析結果が空でした。")
+    output_path = job["output"]
+    # 書きかけの.xlsxが残らないよう、一時ファイルへ直接書き込んでから置き換える
+    with atomic_output(output_path) as f:
+        write_excel_file(f, steps, job["manual_number"], job["author"], job["date"], job["path"],
+                         image_format=args.image_format, image_quality=args.image_quality,
+                         image_size=(args.image_max_width, args.image_max_width * 3 // 4))
+    progress.record(job["name"], status="done", output=output_path, steps=len(steps), error=None)
+    return "done", output_path
+
+def print_perf_summary(recorder):
+    summary = recorder.summary()
+    if not summary: return
+    print("\n処理時間の内訳:")
+    for row in summary:
+        print(f"  {row['stage']:<22} {row['calls']:>5}回  合計 {row['total_s']:8.2f}秒  平均 {row['avg_s']:7.3f}秒  最大 {row['max_s']:7.3f}秒  {row['bytes'] / 1024 ** 2:8.2f}MB")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="動画フォルダから標準作業手順書(.xlsx)をまとめて作成します。")
+    parser.add_argument("video_dir", help="動画(.mp4/.mov)の入ったフォルダ")
+    parser.add_argument("-o", "--output-dir", default="sop_output", help="Excelと progress.json の出力先")
+    parser.add_argument("--model", default="gemini-1.5-flash", help="使用するGeminiモデル")
+    parser.add_argument("--author", default="管理者", help="作成者")
+    parser.add_argument("--date", type=datetime.date.fromisoformat, default=datetime.date.today(), help="作成日 (YYYY-MM-DD)")
+    parser.add_argument("--number-format", default="SOP-{index:03d}", help="マニュアル番号の書式。{index}（初回実行時に割り当て、以後固定の通し番号）と {stem}（ファイル名）が使えます")
+    parser.add_argument("--metadata", help="動画ごとの番号・作成者・作成日・モデルを上書きするJSONファイル")
+    parser.add_argument("--fallback-model", action="append", default=[], help="生成できないときに順に試すモデル（複数指定可）")
+    parser.add_argument("--workers", type=int, default=2, help="同時に処理する動画の数")
+    parser.add_argument("--proxy", action="store_true", help="軽量プロキシで解析する（長い動画は区間に分けて並列解析）")
+    parser.add_argument("--no-cache", action="store_true", help="前回の解析結果を使わずに再解析する")
+    parser.add_argument("--image-format", choices=EXCEL_IMAGE_FORMATS, default=EXCEL_IMAGE_FORMAT, help="Excelに埋め込む画像の形式")
+    parser.add_argument("--image-quality", type=int, default=EXCEL_IMAGE_QUALITY, help="JPEG画質 (1-95)")
+    parser.add_argument("--image-max-width", type=int, default=EXCEL_IMAGE_MAX_SIZE[0], help="埋め込む画像の最大幅(px)。高さは4:3で決まります。既定は表示枠と同じ320で、拡大して見たい場合は大きくします")
+    parser.add_argument("--perf-log", help="処理ごとの所要時間をJSON行で書き出すファイル（- で標準エラー）")
+    parser.add_argument("--api-key", default=os.environ.get("GOOGLE_API_KEY"), help="Google API Key（省略時は環境変数 GOOGLE_API_KEY）")
+    args = parser.parse_args(argv)
+
+    if not args.api_key:
+        parser.error("APIキーが必要です（--api-key または環境変数 GOOGLE_API_KEY）")
+    os.makedirs(args.output_dir, exist_ok=True)
+    progress = BatchProgress(os.path.join(args.output_dir, PROGRESS_FILENAME))
+    jobs = build_jobs(args, progress)
+    if not jobs:
+        print(f"動画が見つかりませんでした: {args.video_dir}", file=sys.stderr)
+        return 1
+    conflicts = find_output_conflicts(jobs)
+    if conflicts:
+        for names in conflicts:
+            print(f"同じマニュアル番号（出力ファイル）になる動画があります: {', '.join(names)}", file=sys.stderr)
+        print("--number-format かメタデータの manual_number を見直してください。", file=sys.stderr)
+        return 1
+
+    if args.perf_log: configure_perf_log(args.perf_log)
+    failures = 0
+    with perf_recording(PerfRecorder()) as recorder, ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = {submit_in_context(executor, process_job, job, args, args.api_key, progress): job for job in jobs}
+        for done, future in enumerate(as_completed(futures), 1):
+            job = futures[future]
+            try:
+                status, output_path = future.result()
+                label = "スキップ（作成済み）" if status == "skipped" else "完了"
+                print(f"[{done}/{len(jobs)}] {label}: {job['name']} -> {output_path}")
+            except Exception as e:
+                failures += 1
+                progress.record(job["name"], status="failed", error=str(e))
+                print(f"[{done}/{len(jobs)}] 失敗: {job['name']}: {e}", file=sys.stderr)
+    print_perf_summary(recorder)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())